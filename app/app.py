@@ -1,6 +1,7 @@
 from utils import auth, utils, service
 from frontend import *
 import streamlit as st
+import uuid
 
 config = utils.read_configs("./configs.yaml")
 
@@ -25,6 +26,10 @@ def set_session(force=False):
     #
     if force or "history" not in st.session_state:
         st.session_state["history"] = []
+    ## Set session_id state, used by the backend to keep the history server side
+    #
+    if force or "session_id" not in st.session_state:
+        st.session_state["session_id"] = str(uuid.uuid4())
     ## Set Chatbot system message
     #
     if force or "system_message" not in st.session_state:
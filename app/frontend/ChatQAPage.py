@@ -52,6 +52,15 @@ class ChatQAPage(Page):
                         st.image(image=url, width=300)
                     st.markdown('----')
 
+    def print_stream(self, st, placeholder, prompt, text):
+        with placeholder.container():
+            self.print_answer(st, None, {
+                "user": prompt,
+                "answer": {
+                    "answer": text
+                }
+            })
+
     def print_history(self, st, config, index, chat_message):
         with st.expander(f'**Question {index}**: {chat_message["user"]}'):
             if chat_message["answer"]:
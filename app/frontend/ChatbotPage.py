@@ -33,6 +33,10 @@ class ChatbotPage(Page):
                 message(st.session_state["chat_messages"][i]["user"], is_user=True, key=str(i) + '_user')
             message(st.session_state["chat_messages"][i]["answer"]["answer"], key=str(i))
 
+    def print_stream(self, st, placeholder, prompt, text):
+        # streamlit_chat needs a unique key per message, so the partial answer is rendered as plain markdown
+        placeholder.markdown(f"**{prompt}**\n\n{text}")
+
     def set_system_message(self, st):
         if "system_message" not in st.session_state or not st.session_state["system_message"]:
             st.session_state["chat_messages"].append({
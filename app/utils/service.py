@@ -68,20 +68,32 @@ def check_indexing_status(st, config):
 
         raise e
 
-def get_answer(st, config, selected_type, selected_endpoint, prompt):
-    print("Get Answer for ", prompt)
-
-    sources = []
-
+def get_payload(st, config, selected_type, selected_endpoint, prompt, stream=False):
     payload = {
         "user": st.session_state["username"] if "username" in st.session_state else "",
         "question": prompt,
-        "chat_memory": st.session_state["history"],
         "llm_endpoint": selected_endpoint,
         "embeddings_endpoint": "GPT-J",
-        "selected_type": selected_type
+        "selected_type": selected_type,
+        "stream": stream
     }
 
+    ## With server_history the backend keeps the conversation, only the session id is sent
+    #
+    if config["backend"].get("server_history", False):
+        payload["session_id"] = st.session_state["session_id"]
+    else:
+        payload["chat_memory"] = st.session_state["history"]
+
+    return payload
+
+def get_answer(st, config, selected_type, selected_endpoint, prompt):
+    print("Get Answer for ", prompt)
+
+    sources = []
+
+    payload = get_payload(st, config, selected_type, selected_endpoint, prompt)
+
     payload_dump = json.dumps(payload)
 
     response = lambda_client.invoke(
@@ -102,6 +114,49 @@ def get_answer(st, config, selected_type, selected_endpoint, prompt):
             "sources": sources
         }
 
+## get_answer_stream
+#   Generator of the frames sent by the backend in streaming mode: {"type": "token", "text": ...} while the answer is
+#   generated, then a final {"type": "answer", "answer": ..., "sources": ...}.
+#   Without the stream_runtime.py exec wrapper, the frames arrive at once inside the Lambda response envelope.
+def get_answer_stream(st, config, selected_type, selected_endpoint, prompt):
+    print("Stream Answer for ", prompt)
+
+    payload = get_payload(st, config, selected_type, selected_endpoint, prompt, stream=True)
+
+    response = lambda_client.invoke_with_response_stream(
+        FunctionName=config["backend"]["function_name"],
+        Payload=json.dumps(payload)
+    )
+
+    buffer = ""
+
+    for event in response["EventStream"]:
+        if "PayloadChunk" in event:
+            buffer += event["PayloadChunk"]["Payload"].decode("utf-8")
+
+            while "\n" in buffer:
+                line, buffer = buffer.split("\n", 1)
+
+                if line.strip():
+                    yield json.loads(line)
+
+    if buffer.strip():
+        frame = json.loads(buffer)
+
+        if "type" in frame:
+            yield frame
+        elif "statusCode" in frame and frame["statusCode"] == 200 and "body" in frame:
+            for line in frame["body"].split("\n"):
+                yield json.loads(line)
+        else:
+            print(frame)
+
+            yield {
+                "type": "answer",
+                "answer": "Unfortunately, I can't help you with that.",
+                "sources": []
+            }
+
 def get_presigned_url(bucket_name, object_key):
     try:
         url = s3_client.generate_presigned_url(
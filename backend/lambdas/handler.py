@@ -1,22 +1,38 @@
 from __future__ import annotations
+import asyncio
 import boto3
+from botocore.exceptions import ClientError
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import contextvars
+import copy
 import json
-from langchain import SagemakerEndpoint
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.callbacks.manager import AsyncCallbackManagerForChainRun, AsyncCallbackManagerForLLMRun, \
+    CallbackManagerForChainRun, CallbackManagerForLLMRun
 from langchain.chains import ConversationalRetrievalChain
+from langchain.chains.conversational_retrieval.base import _get_chat_history
 from langchain.embeddings import SagemakerEndpointEmbeddings
 from langchain.embeddings.sagemaker_endpoint import EmbeddingsContentHandler
-from langchain.llms.sagemaker_endpoint import LLMContentHandler
-from langchain.memory import ConversationBufferWindowMemory, ConversationSummaryMemory
+from langchain.llms.sagemaker_endpoint import LLMContentHandler, SagemakerEndpoint
+from langchain.memory import ConversationBufferWindowMemory
 from langchain.memory.chat_memory import BaseChatMemory
 from langchain.memory.chat_message_histories.in_memory import ChatMessageHistory
-from langchain.memory.summary import SummarizerMixin
 from langchain.memory.utils import get_prompt_input_key
 from langchain.schema import BaseChatMessageHistory, BaseRetriever, Document
 from langchain.prompts import PromptTemplate
 from langchain.vectorstores import OpenSearchVectorSearch
+from langchain.vectorstores.opensearch_vector_search import _default_approximate_search_query
+from functools import partial
 import logging
+import numpy as np
 import os
 from pydantic import Field
+import queue
+import re
+import threading
+import time
 import traceback
 from typing import Any, Dict, List, Optional, Tuple
 import yaml
@@ -29,9 +45,41 @@ else:
 
 bucket = os.getenv("s3_bucket", default=None)
 config_file = os.getenv("genai_configs", default=None)
+chain_cache_size = int(os.getenv("CHAIN_CACHE_SIZE", default=8))
+config_cache_ttl = int(os.getenv("CONFIG_CACHE_TTL", default=60))
+embedding_cache_size = int(os.getenv("EMBEDDING_CACHE_SIZE", default=256))
+embedding_cache_ttl = int(os.getenv("EMBEDDING_CACHE_TTL", default=3600))
+embedding_cache_path = os.getenv("EMBEDDING_CACHE_PATH", default=None)
+answer_cache_size = int(os.getenv("ANSWER_CACHE_SIZE", default=128))
+# Cached answers across every index, each keeps its 4096-dim float32 question embedding (16 KiB)
+answer_cache_max_entries = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", default=2048))
+answer_cache_generation_ttl = int(os.getenv("ANSWER_CACHE_GENERATION_TTL", default=30))
+backend_async = os.getenv("BACKEND_ASYNC", default="false").lower() == "true"
+session_store_type = os.getenv("SESSION_STORE", default="memory")
+session_store_path = os.getenv("SESSION_STORE_PATH", default="/tmp/sessions.db")
+session_store_size = int(os.getenv("SESSION_STORE_SIZE", default=1024))
+batch_concurrency = int(os.getenv("BATCH_CONCURRENCY", default=4))
+metrics_sink_type = os.getenv("METRICS_SINK", default="emf")
+metrics_namespace = os.getenv("METRICS_NAMESPACE", default="GenAIQARAG")
+
+encoding = None
 
 s3_client = boto3.client('s3')
 
+# Per-request metrics, see Metrics and timed
+current_metrics = contextvars.ContextVar("current_metrics", default=None)
+
+# Tenant of the request when es_credentials.tenancy is "shared", see set_tenant
+current_tenant = contextvars.ContextVar("current_tenant", default=None)
+default_tenant = "_default"
+
+# Event loop kept across invocations, so that the async OpenSearch sessions of the cached chains stay usable
+event_loop = asyncio.new_event_loop()
+
+# Built chains kept across invocations of a warm container, keyed by
+# (embedding endpoint, LLM endpoint, index name, selected type)
+chain_cache = OrderedDict()
+
 falcon_template = """
     Use the following pieces of context to answer the question at the end. You must not answer a question not related to the documents.
     If you don't know the answer, just say "Unfortunately, I can't help you with that", don't try to make up an answer.
@@ -44,19 +92,656 @@ falcon_template = """
     Detailed Answer:
 """
 
-def read_configs(s3_bucket, file_path):
-    try:
-        response = s3_client.get_object(Bucket=s3_bucket, Key=file_path)
+class Metrics:
+    def __init__(self, dimensions):
+        self.dimensions = dimensions
+        self.start = time.perf_counter()
+        self.timings = {}
+        self.values = {}
+        self.active = set()
+
+    @contextmanager
+    def stage(self, name):
+        self.active.add(name)
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.active.discard(name)
+            self.add_timing(name, (time.perf_counter() - start) * 1000)
+
+    def add_timing(self, name, milliseconds):
+        self.timings[name] = self.timings.get(name, 0) + milliseconds
+
+    def add(self, name, value):
+        self.values[name] = self.values.get(name, 0) + value
+
+    def to_dict(self):
+        return {
+            **{f"{name}_ms": round(value, 2) for name, value in self.timings.items()},
+            **self.values
+        }
+
+@contextmanager
+def timed(name):
+    # No-op outside of a request, e.g. in the batch workers
+    metrics = current_metrics.get()
+
+    if metrics is None:
+        yield
+    else:
+        with metrics.stage(name):
+            yield
+
+def add_metric(name, value):
+    metrics = current_metrics.get()
+
+    if metrics is not None:
+        metrics.add(name, value)
+
+class MetricsSink:
+    def emit(self, metrics):
+        raise NotImplementedError
+
+class EMFMetricsSink(MetricsSink):
+    # CloudWatch Embedded Metric Format: the log line is turned into metrics by CloudWatch Logs
+    def __init__(self, namespace):
+        self.namespace = namespace
+
+    @staticmethod
+    def get_unit(name):
+        # The unit follows the metric name suffix, see Metrics.to_dict
+        if name.endswith("_ms"):
+            return "Milliseconds"
+        elif name.endswith("_bytes"):
+            return "Bytes"
+        else:
+            return "Count"
+
+    def emit(self, metrics):
+        values = metrics.to_dict()
+
+        print(json.dumps({
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [list(metrics.dimensions.keys())],
+                    "Metrics": [{"Name": name, "Unit": self.get_unit(name)} for name in values]
+                }]
+            },
+            **metrics.dimensions,
+            **values
+        }))
+
+class LogMetricsSink(MetricsSink):
+    def emit(self, metrics):
+        logger.info(json.dumps({"metrics": metrics.to_dict(), **metrics.dimensions}))
+
+class NoopMetricsSink(MetricsSink):
+    def emit(self, metrics):
+        pass
+
+def get_metrics_sink():
+    if metrics_sink_type == "log":
+        return LogMetricsSink()
+    elif metrics_sink_type == "none":
+        return NoopMetricsSink()
+    else:
+        return EMFMetricsSink(metrics_namespace)
+
+metrics_sink = get_metrics_sink()
+
+class ConfigCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.config = None
+        self.etag = None
+        self.expires_at = 0
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+
+    def get(self, s3_bucket, file_path):
+        now = time.monotonic()
+
+        if self.config is not None and now < self.expires_at:
+            self.hits += 1
+            return copy.deepcopy(self.config)
+
+        kwargs = {"Bucket": s3_bucket, "Key": file_path}
+        if self.config is not None and self.etag is not None:
+            kwargs["IfNoneMatch"] = self.etag
+
+        try:
+            response = s3_client.get_object(**kwargs)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ["304", "NotModified"]:
+                raise e
+
+            logger.info("Configs not modified, keeping cached version")
+            self.hits += 1
+            self.expires_at = now + self.ttl
+
+            return copy.deepcopy(self.config)
+
+        if self.config is None:
+            self.misses += 1
+        else:
+            logger.info("Configs changed, reloading")
+            self.refreshes += 1
+            chain_cache.clear()
+            registry.clear()
+
+        self.config = yaml.safe_load(response["Body"])
+        self.etag = response.get("ETag")
+        self.expires_at = now + self.ttl
+
+        return copy.deepcopy(self.config)
+
+    def invalidate(self):
+        self.config = None
+        self.etag = None
+        self.expires_at = 0
+        chain_cache.clear()
+        registry.clear()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes
+        }
 
-        config = yaml.safe_load(response["Body"])
+config_cache = ConfigCache(config_cache_ttl)
 
-        return config
+def read_configs(s3_bucket, file_path):
+    try:
+        return config_cache.get(s3_bucket, file_path)
     except yaml.YAMLError as e:
         stacktrace = traceback.format_exc()
         logger.error(stacktrace)
 
         return e
 
+def invalidate_configs():
+    logger.info("Invalidating cached configs")
+
+    config_cache.invalidate()
+
+    return config_cache.stats()
+
+class EmbeddingCache:
+    # Expired rows of the shared tier are deleted at most once per interval, not on every put
+    eviction_interval = 60
+
+    def __init__(self, max_size, ttl, path=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.connection = None
+        # The SQLite connection is shared by the request and batch threads
+        self.lock = threading.Lock()
+        self.evicted_at = 0
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Optional shared tier: a SQLite file that every process of the container (or a mounted volume) can reuse
+        if path:
+            import sqlite3
+
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB, created_at REAL)"
+            )
+            self.connection.commit()
+
+    @staticmethod
+    def normalize(text):
+        return re.sub(r"\s+", " ", text).strip().lower()
+
+    def get(self, endpoint_name, text):
+        key = f"{endpoint_name}|{self.normalize(text)}"
+        now = time.time()
+
+        if key in self.entries:
+            embedding, created_at = self.entries[key]
+
+            if now - created_at < self.ttl:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return embedding.tolist()
+
+            del self.entries[key]
+
+        if self.connection is not None:
+            with self.lock:
+                row = self.connection.execute(
+                    "SELECT embedding, created_at FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+
+            if row is not None and now - row[1] < self.ttl:
+                embedding = np.frombuffer(row[0], dtype=np.float32)
+                self._set(key, embedding, row[1])
+                self.shared_hits += 1
+                return embedding.tolist()
+
+        self.misses += 1
+
+        return None
+
+    def put(self, endpoint_name, text, embedding):
+        key = f"{endpoint_name}|{self.normalize(text)}"
+        embedding = np.asarray(embedding, dtype=np.float32)
+        now = time.time()
+
+        self._set(key, embedding, now)
+
+        if self.connection is not None:
+            with self.lock:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO embeddings (key, embedding, created_at) VALUES (?, ?, ?)",
+                    (key, embedding.tobytes(), now)
+                )
+
+                if now - self.evicted_at >= self.eviction_interval:
+                    self.connection.execute("DELETE FROM embeddings WHERE created_at < ?", (now - self.ttl,))
+                    self.evicted_at = now
+
+                self.connection.commit()
+
+    def _set(self, key, embedding, created_at):
+        self.entries[key] = (embedding, created_at)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+embedding_cache = EmbeddingCache(embedding_cache_size, embedding_cache_ttl, embedding_cache_path)
+
+class SagemakerEndpointEmbeddingsExtended(SagemakerEndpointEmbeddings):
+    def embed_query(self, text: str) -> List[float]:
+        with timed("query_embedding"):
+            embedding = embedding_cache.get(self.endpoint_name, text)
+
+            if embedding is None:
+                embedding = super().embed_query(text)
+                embedding_cache.put(self.endpoint_name, text, embedding)
+
+        return embedding
+
+    async def aembed_query(self, text: str) -> List[float]:
+        with timed("query_embedding"):
+            embedding = embedding_cache.get(self.endpoint_name, text)
+
+            if embedding is None:
+                # boto3 is blocking, the endpoint call runs in the default executor
+                embedding = await asyncio.get_running_loop().run_in_executor(
+                    None, partial(SagemakerEndpointEmbeddings.embed_query, self, text)
+                )
+                embedding_cache.put(self.endpoint_name, text, embedding)
+
+        return embedding
+
+class AnswerCache:
+    # Up to max_size answers per (index, tenant, llm, selected type) key, and max_entries answers in total: the least
+    # recently used keys are dropped first
+    def __init__(self, max_size, generation_ttl, max_entries):
+        self.max_size = max_size
+        self.generation_ttl = generation_ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.generations = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def get_generation(self, client, index_name, tenant=None):
+        # The indexing Lambdas stamp the index mapping _meta after every rebuild, or the tenant's generation document
+        # in a shared index, see mark_index_updated
+        now = time.monotonic()
+        cached = self.generations.get((index_name, tenant))
+
+        if cached is not None and now < cached[1]:
+            return cached[0]
+
+        try:
+            if tenant is None:
+                response = client.indices.get_mapping(index=index_name)
+                generation = next(iter(response.values()))["mappings"].get("_meta", {}).get("updated_at")
+            else:
+                response = client.get(index=index_name, id=f"_generation-{tenant}", routing=tenant)
+                generation = response["_source"]["updated_at"]
+        except Exception:
+            generation = None
+
+        self.generations[(index_name, tenant)] = (generation, now + self.generation_ttl)
+        self.generations.move_to_end((index_name, tenant))
+
+        while len(self.generations) > self.max_entries:
+            self.generations.popitem(last=False)
+
+        return generation
+
+    def lookup(self, key, generation, embedding, threshold):
+        entry = self.entries.get(key)
+
+        if entry is not None and entry["generation"] != generation:
+            logger.info(f"Index rebuilt, dropping cached answers for {key}")
+            self.remove(key)
+            self.invalidations += 1
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+
+        query = np.asarray(embedding, dtype=np.float32)
+        similarities = entry["embeddings"] @ query / (entry["norms"] * np.linalg.norm(query) + 1e-10)
+        best = int(np.argmax(similarities))
+
+        if similarities[best] < threshold:
+            self.misses += 1
+            return None
+
+        logger.info(f"Semantic cache hit with similarity {similarities[best]:.4f}")
+        self.hits += 1
+
+        return entry["answers"][best]
+
+    def add(self, key, generation, embedding, answer):
+        query = np.asarray(embedding, dtype=np.float32)[np.newaxis, :]
+        entry = self.entries.get(key)
+
+        if entry is None or entry["generation"] != generation:
+            self.remove(key)
+            entry = {
+                "generation": generation,
+                "embeddings": np.empty((0, query.shape[1]), dtype=np.float32),
+                "norms": np.empty(0, dtype=np.float32),
+                "answers": []
+            }
+            self.entries[key] = entry
+
+        self.entries.move_to_end(key)
+        self.size -= len(entry["answers"])
+        entry["embeddings"] = np.concatenate([entry["embeddings"], query])[-self.max_size:]
+        entry["norms"] = np.concatenate([entry["norms"], np.linalg.norm(query, axis=1)])[-self.max_size:]
+        entry["answers"] = (entry["answers"] + [answer])[-self.max_size:]
+        self.size += len(entry["answers"])
+
+        while self.size > self.max_entries and len(self.entries) > 1:
+            self.remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+
+        if entry is not None:
+            self.size -= len(entry["answers"])
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            "keys": len(self.entries),
+            "size": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions
+        }
+
+answer_cache = AnswerCache(answer_cache_size, answer_cache_generation_ttl, answer_cache_max_entries)
+
+def get_encoding():
+    # Same encoding as the indexing Lambdas, loaded on first use only
+    global encoding
+
+    if encoding is None:
+        import tiktoken
+
+        encoding = tiktoken.get_encoding('cl100k_base')
+
+    return encoding
+
+def get_overlap(first, second, max_overlap=300):
+    # Length of the longest suffix of first that is a prefix of second
+    for size in range(min(len(first), len(second), max_overlap), 0, -1):
+        if first.endswith(second[:size]):
+            return size
+
+    return 0
+
+def get_shingles(text, size=3):
+    words = text.lower().split()
+
+    return {" ".join(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+def pack_documents(docs, token_budget=None, dedup_threshold=0.9, min_overlap=20):
+    # 1. Merge overlapping chunks of the same file and page (chunks are split with chunk_overlap=200)
+    packed = []
+
+    for doc in docs:
+        for other in packed:
+            if (other.metadata.get("file_name"), other.metadata.get("page")) != \
+                    (doc.metadata.get("file_name"), doc.metadata.get("page")):
+                continue
+
+            if doc.page_content in other.page_content:
+                break
+
+            if other.page_content in doc.page_content:
+                other.page_content = doc.page_content
+                break
+
+            overlap = get_overlap(other.page_content, doc.page_content)
+            if overlap >= min_overlap:
+                other.page_content = other.page_content + doc.page_content[overlap:]
+                break
+
+            overlap = get_overlap(doc.page_content, other.page_content)
+            if overlap >= min_overlap:
+                other.page_content = doc.page_content + other.page_content[overlap:]
+                break
+        else:
+            packed.append(Document(page_content=doc.page_content, metadata=dict(doc.metadata)))
+
+    # 2. Drop near-duplicates across files and pages
+    deduplicated = []
+    shingles = []
+
+    for doc in packed:
+        doc_shingles = get_shingles(doc.page_content)
+
+        if any(len(doc_shingles & other) / max(len(doc_shingles | other), 1) >= dedup_threshold for other in shingles):
+            continue
+
+        deduplicated.append(doc)
+        shingles.append(doc_shingles)
+
+    if token_budget is None:
+        return deduplicated
+
+    # 3. Fill the token budget in retrieval order
+    results = []
+    used_tokens = 0
+
+    for doc in deduplicated:
+        n_tokens = len(get_encoding().encode(doc.page_content))
+
+        if used_tokens + n_tokens > token_budget:
+            continue
+
+        results.append(doc)
+        used_tokens += n_tokens
+
+    logger.info(f"Context packed from {len(docs)} to {len(results)} documents, {used_tokens} tokens")
+
+    return results
+
+def copy_model(model, **update):
+    # BaseModel.copy drops the fields declared with exclude=True, such as callbacks
+    return model.__class__.construct(_fields_set=model.__fields_set__, **{**model.__dict__, **update})
+
+class SessionStore:
+    def get_turns(self, user, session_id, limit):
+        raise NotImplementedError
+
+    def append_turn(self, user, session_id, question, answer):
+        raise NotImplementedError
+
+class InMemorySessionStore(SessionStore):
+    def __init__(self, max_sessions, max_turns=20):
+        self.max_sessions = max_sessions
+        self.max_turns = max_turns
+        self.sessions = OrderedDict()
+
+    def get_turns(self, user, session_id, limit):
+        turns = self.sessions.get((user, session_id), [])
+
+        return [list(turn) for turn in turns][-limit:] if limit > 0 else []
+
+    def append_turn(self, user, session_id, question, answer):
+        key = (user, session_id)
+        turns = self.sessions.setdefault(key, [])
+
+        turns.append((question, answer))
+        del turns[:-self.max_turns]
+
+        self.sessions.move_to_end(key)
+
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+
+class SQLiteSessionStore(SessionStore):
+    def __init__(self, path):
+        import sqlite3
+
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS turns (id INTEGER PRIMARY KEY AUTOINCREMENT, user TEXT, session_id TEXT, "
+            "question TEXT, answer TEXT, created_at REAL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS turns_session ON turns (user, session_id, id)")
+        self.connection.commit()
+
+    def get_turns(self, user, session_id, limit):
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT question, answer FROM turns WHERE user = ? AND session_id = ? ORDER BY id DESC LIMIT ?",
+                (user, session_id, limit)
+            ).fetchall()
+
+        return [list(row) for row in reversed(rows)]
+
+    def append_turn(self, user, session_id, question, answer):
+        with self.lock:
+            self.connection.execute(
+                "INSERT INTO turns (user, session_id, question, answer, created_at) VALUES (?, ?, ?, ?, ?)",
+                (user, session_id, question, answer, time.time())
+            )
+            self.connection.commit()
+
+def get_session_store():
+    if session_store_type == "sqlite":
+        return SQLiteSessionStore(session_store_path)
+    else:
+        return InMemorySessionStore(session_store_size)
+
+session_store = get_session_store()
+
+def get_chat_memory(event, memory_window):
+    # Clients that send a session id only send the new question, the history is kept server side
+    if event.get("session_id") is not None:
+        return session_store.get_turns(event["user"], event["session_id"], memory_window)
+
+    return event["chat_memory"]
+
+def get_history(chat_memory):
+    history = ChatMessageHistory()
+
+    for message in chat_memory:
+        history.add_user_message(message[0])
+        history.add_ai_message(message[1])
+
+    return history
+
+def save_turn(event, result):
+    if event.get("session_id") is not None:
+        session_store.append_turn(event["user"], event["session_id"], event["question"], result["answer"])
+
+class Registry:
+    def __init__(self):
+        self.content_handler_classes = {}
+        self.templates = {}
+        self.variants = {}
+        self.content_handlers = {}
+        self.prompts = {}
+
+    def register_content_handler(self, name, handler_class):
+        self.content_handler_classes[name] = handler_class
+
+    def register_template(self, name, template):
+        self.templates[name] = template
+
+    def register_variant(self, name, replace_strings):
+        self.variants[name] = replace_strings
+
+    def get_content_handler(self, name):
+        if name not in self.content_handlers:
+            if name not in self.content_handler_classes:
+                raise ValueError(f"Unknown content handler {name}")
+
+            self.content_handlers[name] = self.content_handler_classes[name]()
+
+        return self.content_handlers[name]
+
+    def get_prompt(self, name, variant=None):
+        key = (name, variant)
+
+        if key not in self.prompts:
+            if name not in self.templates:
+                raise ValueError(f"Unknown prompt template {name}")
+
+            prompt_template = self.templates[name]
+
+            for item in self.variants.get(variant, []):
+                prompt_template = prompt_template.replace(item["key"], item["value"])
+
+            self.prompts[key] = PromptTemplate(
+                template=prompt_template, input_variables=["context", "question", "chat_history"]
+            )
+
+        return self.prompts[key]
+
+    def clear(self):
+        # Called when a new config version is loaded
+        self.content_handlers = {}
+        self.prompts = {}
+
+registry = Registry()
+
 class Chain:
     def __init__(self, embedding_endpoint, llm_endpoint):
         self.embedding_endpoint = embedding_endpoint
@@ -65,15 +750,19 @@ class Chain:
         self.vector_search = None
         self.retriever = None
         self.llm = None
-        self.memory = None
+        self.memory_window = None
+        self.condense_strategy = None
+        self.context_token_budget = None
+        self.qa = None
+        self.streaming_qa = None
 
-    def build(self, config, history=[]):
+    def build(self, config):
         region = os.getenv("AWS_DEFAULT_REGION", "eu-west-1")
 
         embedding_endpoint_name = config["embeddings"][self.embedding_endpoint]["endpoint_name"]
-        embedding_handler = eval(config["embeddings"][self.embedding_endpoint]["content_handler"])()
+        embedding_handler = registry.get_content_handler(config["embeddings"][self.embedding_endpoint]["content_handler"])
 
-        self.embeddings = SagemakerEndpointEmbeddings(
+        self.embeddings = SagemakerEndpointEmbeddingsExtended(
             endpoint_name=embedding_endpoint_name,
             region_name=region,
             content_handler=embedding_handler
@@ -86,68 +775,94 @@ class Chain:
             http_auth=(config["es_credentials"]["username"], config["es_credentials"]["password"])
         )
 
+        if backend_async:
+            # The async client pulls in the aiohttp transport, only the async path loads it
+            from opensearchpy import AsyncOpenSearch
+
+            async_client = AsyncOpenSearch(
+                hosts=[config["es_credentials"]["endpoint"]],
+                http_auth=(config["es_credentials"]["username"], config["es_credentials"]["password"])
+            )
+        else:
+            async_client = None
+
         self.retriever = DocumentRetrieverExtended(
             self.vector_search,
             "embedding",
             "passage",
             k=config["llms"][self.llm_endpoint]["query_results"],
+            score_threshold=config["llms"][self.llm_endpoint].get("score_threshold"),
+            hybrid_score_threshold=config["llms"][self.llm_endpoint].get("hybrid_score_threshold"),
+            async_client=async_client,
+            search_type=config["llms"][self.llm_endpoint].get("search_type", "knn"),
+            hybrid_candidates=config["llms"][self.llm_endpoint].get("hybrid_candidates", 10),
+            rrf_k=config["llms"][self.llm_endpoint].get("rrf_k", 60),
+            candidates=config["llms"][self.llm_endpoint].get("query_candidates"),
+            score_gap=config["llms"][self.llm_endpoint].get("score_gap"),
+            min_results=config["llms"][self.llm_endpoint].get("min_results", 1),
+            space_type=config["llms"][self.llm_endpoint].get("space_type"),
+            tenancy=config["es_credentials"].get("tenancy", "index")
         )
 
         llm_endpoint_name = config["llms"][self.llm_endpoint]["endpoint_name"]
-        llm_handler = eval(config["llms"][self.llm_endpoint]["content_handler"])()
+        llm_handler = registry.get_content_handler(config["llms"][self.llm_endpoint]["content_handler"])
         llm_model_kwargs = config["llms"][self.llm_endpoint]["model_kwargs"]
 
-        self.llm = SagemakerEndpoint(
+        self.llm = SagemakerEndpointExtended(
             endpoint_name=llm_endpoint_name,
             region_name=region,
             model_kwargs=llm_model_kwargs,
             content_handler=llm_handler
         )
 
-        self.memory = ConversationBufferWindowMemoryExtended(
-            k=config["llms"][self.llm_endpoint]["memory_window"],
+        self.memory_window = config["llms"][self.llm_endpoint]["memory_window"]
+        self.condense_strategy = config["llms"][self.llm_endpoint].get("condense_strategy", "condense")
+        self.context_token_budget = config["llms"][self.llm_endpoint].get("context_tokens")
+
+    def get_streaming_qa(self):
+        # Only the answer generation streams, the question condensing keeps the blocking LLM
+        if self.streaming_qa is None:
+            streaming_llm = copy_model(self.llm, streaming=True)
+            llm_chain = copy_model(self.qa.combine_docs_chain.llm_chain, llm=streaming_llm)
+            combine_docs_chain = copy_model(self.qa.combine_docs_chain, llm_chain=llm_chain)
+
+            self.streaming_qa = copy_model(self.qa, combine_docs_chain=combine_docs_chain)
+
+        return self.streaming_qa
+
+    def with_memory(self, history, streaming=False):
+        memory = ConversationBufferWindowMemoryExtended(
+            k=self.memory_window,
             chat_memory=history,
             memory_key="chat_history",
             return_messages=True)
 
+        qa = self.get_streaming_qa() if streaming else self.qa
+
+        # Shallow copy: the cached embeddings, vector store, LLM and prompt are shared, only the memory is per request
+        return copy_model(qa, memory=memory)
+
 class ChatbotChain(Chain):
     def __init__(self, embedding_endpoint, llm_endpoint):
         logger.info("Building ChatbotChain")
 
         super().__init__(embedding_endpoint, llm_endpoint)
-        self.replace_strings = [
-            {
-                "key": "The AI keeps the answer conversational and provides lots of specific details from its context.",
-                "value": "The AI keeps the answer conversational and provides lots of specific details from its context. Please keep the answer in 50 words or less."
-            },
-            {
-
-                "key": "Use the following pieces of context to answer the question at the end.",
-                "value": "Use the following pieces of context to answer the question at the end. Please keep the answer in 50 words or less."
-            }
-        ]
 
-    def build(self, config, history=[]):
-        super().build(config, history)
+    def build(self, config):
+        super().build(config)
 
-        prompt_template = eval(config["llms"][self.llm_endpoint]["template"])
+        PROMPT = registry.get_prompt(config["llms"][self.llm_endpoint]["template"], "chatbot")
 
-        for item in self.replace_strings:
-            prompt_template = prompt_template.replace(item["key"], item["value"])
-
-        PROMPT = PromptTemplate(
-            template=prompt_template, input_variables=["context", "question", "chat_history"]
-        )
-
-        qa = ConversationalRetrievalChain.from_llm(
+        self.qa = ConversationalRetrievalChainExtended.from_llm(
             llm=self.llm,
             retriever=self.retriever,
             combine_docs_chain_kwargs={"prompt": PROMPT},
             return_source_documents=True,
-            memory=self.memory
+            condense_strategy=self.condense_strategy,
+            context_token_budget=self.context_token_budget
         )
 
-        return qa
+        return self.qa
 
 class ChatQAChain(Chain):
     def __init__(self, embedding_endpoint, llm_endpoint):
@@ -155,25 +870,247 @@ class ChatQAChain(Chain):
 
         super().__init__(embedding_endpoint, llm_endpoint)
 
-    def build(self, config, history=[]):
-        super().build(config, history)
+    def build(self, config):
+        super().build(config)
 
-        prompt_template = eval(config["llms"][self.llm_endpoint]["template"])
+        PROMPT = registry.get_prompt(config["llms"][self.llm_endpoint]["template"])
 
-        PROMPT = PromptTemplate(
-            template=prompt_template, input_variables=["context", "question", "chat_history"]
-        )
-
-        qa = ConversationalRetrievalChain.from_llm(
+        self.qa = ConversationalRetrievalChainExtended.from_llm(
             llm=self.llm,
             retriever=self.retriever,
             combine_docs_chain_kwargs={"prompt": PROMPT},
             return_source_documents=True,
             verbose=True,
-            memory=self.memory
+            condense_strategy=self.condense_strategy,
+            context_token_budget=self.context_token_budget
         )
 
-        return qa
+        return self.qa
+
+def set_tenant(config, user):
+    # "index" tenancy: one index per user, named after the configured index. "shared": one index for every user, the
+    # retriever filters and routes on the tenant of the request
+    if config["es_credentials"].get("tenancy", "index") == "shared":
+        current_tenant.set(user if user != "" else default_tenant)
+    else:
+        current_tenant.set(None)
+
+        if user != "":
+            config["es_credentials"]["index"] = config["es_credentials"]["index"] + "-" + user
+
+def get_chain(config, embeddings_endpoint, llm_endpoint, selected_type):
+    key = (embeddings_endpoint, llm_endpoint, config["es_credentials"]["index"], selected_type)
+
+    if key in chain_cache:
+        logger.info(f"Reusing cached chain for {key}")
+        chain_cache.move_to_end(key)
+
+        return chain_cache[key]
+
+    if selected_type == "Chat Q&A":
+        chain = ChatQAChain(embeddings_endpoint, llm_endpoint)
+    else:
+        chain = ChatbotChain(embeddings_endpoint, llm_endpoint)
+
+    chain.build(config)
+
+    chain_cache[key] = chain
+
+    while len(chain_cache) > chain_cache_size:
+        evicted, _ = chain_cache.popitem(last=False)
+        logger.info(f"Evicted cached chain for {evicted}")
+
+    return chain
+
+class ConversationalRetrievalChainExtended(ConversationalRetrievalChain):
+    # "condense": rewrite the question with the LLM, then retrieve (default)
+    # "none": no rewrite, retrieve with the last turn and the raw question
+    # "speculative": retrieve with the raw question while the rewrite runs, keep the better result set
+    condense_strategy: str = "condense"
+    context_token_budget: Optional[int] = None
+    dedup_threshold: float = 0.9
+
+    def _get_docs(self, question: str, inputs: Dict[str, Any]) -> List[Document]:
+        docs = self.retriever.get_relevant_documents(question)
+
+        return self._pack_documents(docs)
+
+    async def _aget_docs(self, question: str, inputs: Dict[str, Any]) -> List[Document]:
+        docs = await self.retriever.aget_relevant_documents(question)
+
+        return self._pack_documents(docs)
+
+    def _pack_documents(self, docs):
+        with timed("context_packing"):
+            packed = pack_documents(docs, self.context_token_budget, self.dedup_threshold)
+
+        add_metric("retrieved_docs", len(docs))
+        add_metric("packed_docs", len(packed))
+
+        return packed
+
+    def _call(
+        self,
+        inputs: Dict[str, Any],
+        run_manager: Optional[CallbackManagerForChainRun] = None,
+    ) -> Dict[str, Any]:
+        _run_manager = run_manager or CallbackManagerForChainRun.get_noop_manager()
+        question = inputs["question"]
+        get_chat_history = self.get_chat_history or _get_chat_history
+        chat_history_str = get_chat_history(inputs["chat_history"])
+        timings = {"condense_strategy": self.condense_strategy if chat_history_str else "no_history"}
+
+        start = time.perf_counter()
+
+        if not chat_history_str:
+            new_question = question
+            docs = self._get_docs(question, inputs)
+        elif self.condense_strategy == "none":
+            new_question = question
+            docs = self._get_docs(self._get_last_turn(inputs["chat_history"]) + "\n" + question, inputs)
+        elif self.condense_strategy == "speculative":
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                speculative_docs = executor.submit(contextvars.copy_context().run, self._get_docs, question, inputs)
+
+                with timed("query_condense"):
+                    new_question = self.question_generator.run(
+                        question=question, chat_history=chat_history_str, callbacks=_run_manager.get_child()
+                    )
+
+                docs = speculative_docs.result()
+
+            timings["condense_ms"] = round((time.perf_counter() - start) * 1000, 2)
+
+            if new_question.strip().lower() != question.strip().lower():
+                condensed_docs = self._get_docs(new_question, inputs)
+
+                if self._get_top_score(condensed_docs) >= self._get_top_score(docs):
+                    docs = condensed_docs
+                    timings["kept"] = "condensed"
+                else:
+                    timings["kept"] = "speculative"
+        else:
+            with timed("query_condense"):
+                new_question = self.question_generator.run(
+                    question=question, chat_history=chat_history_str, callbacks=_run_manager.get_child()
+                )
+
+            timings["condense_ms"] = round((time.perf_counter() - start) * 1000, 2)
+
+            docs = self._get_docs(new_question, inputs)
+
+        timings["retrieval_ms"] = round((time.perf_counter() - start) * 1000, 2)
+
+        new_inputs = inputs.copy()
+        new_inputs["question"] = new_question
+        new_inputs["chat_history"] = chat_history_str
+
+        with self._time_prompt_assembly():
+            answer = self.combine_docs_chain.run(
+                input_documents=docs, callbacks=_run_manager.get_child(), **new_inputs
+            )
+
+        timings["total_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        logger.info(json.dumps({"condense_timings": timings}))
+
+        if self.return_source_documents:
+            return {self.output_key: answer, "source_documents": docs}
+        else:
+            return {self.output_key: answer}
+
+    async def _acall(
+        self,
+        inputs: Dict[str, Any],
+        run_manager: Optional[AsyncCallbackManagerForChainRun] = None,
+    ) -> Dict[str, Any]:
+        _run_manager = run_manager or AsyncCallbackManagerForChainRun.get_noop_manager()
+        question = inputs["question"]
+        get_chat_history = self.get_chat_history or _get_chat_history
+        chat_history_str = get_chat_history(inputs["chat_history"])
+        timings = {"condense_strategy": self.condense_strategy if chat_history_str else "no_history"}
+
+        start = time.perf_counter()
+
+        if not chat_history_str:
+            new_question = question
+            docs = await self._aget_docs(question, inputs)
+        elif self.condense_strategy == "none":
+            new_question = question
+            docs = await self._aget_docs(self._get_last_turn(inputs["chat_history"]) + "\n" + question, inputs)
+        elif self.condense_strategy == "speculative":
+            async def condense():
+                with timed("query_condense"):
+                    return await self.question_generator.arun(
+                        question=question, chat_history=chat_history_str, callbacks=_run_manager.get_child()
+                    )
+
+            docs, new_question = await asyncio.gather(self._aget_docs(question, inputs), condense())
+
+            timings["condense_ms"] = round((time.perf_counter() - start) * 1000, 2)
+
+            if new_question.strip().lower() != question.strip().lower():
+                condensed_docs = await self._aget_docs(new_question, inputs)
+
+                if self._get_top_score(condensed_docs) >= self._get_top_score(docs):
+                    docs = condensed_docs
+                    timings["kept"] = "condensed"
+                else:
+                    timings["kept"] = "speculative"
+        else:
+            with timed("query_condense"):
+                new_question = await self.question_generator.arun(
+                    question=question, chat_history=chat_history_str, callbacks=_run_manager.get_child()
+                )
+
+            timings["condense_ms"] = round((time.perf_counter() - start) * 1000, 2)
+
+            docs = await self._aget_docs(new_question, inputs)
+
+        timings["retrieval_ms"] = round((time.perf_counter() - start) * 1000, 2)
+
+        new_inputs = inputs.copy()
+        new_inputs["question"] = new_question
+        new_inputs["chat_history"] = chat_history_str
+        with self._time_prompt_assembly():
+            answer = await self.combine_docs_chain.arun(
+                input_documents=docs, callbacks=_run_manager.get_child(), **new_inputs
+            )
+
+        timings["total_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        logger.info(json.dumps({"condense_timings": timings}))
+
+        if self.return_source_documents:
+            return {self.output_key: answer, "source_documents": docs}
+        else:
+            return {self.output_key: answer}
+
+    @contextmanager
+    def _time_prompt_assembly(self):
+        # Prompt assembly is the combine-docs time that is not spent in the LLM call
+        metrics = current_metrics.get()
+
+        if metrics is None:
+            yield
+            return
+
+        llm_before = metrics.timings.get("llm_generation", 0)
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            llm_ms = metrics.timings.get("llm_generation", 0) - llm_before
+            metrics.add_timing("prompt_assembly", (time.perf_counter() - start) * 1000 - llm_ms)
+
+    def _get_last_turn(self, chat_history):
+        # Messages come in (human, ai) pairs, tuples hold a whole turn
+        last_turn = chat_history[-1:] if chat_history and isinstance(chat_history[-1], tuple) else chat_history[-2:]
+
+        return _get_chat_history(last_turn).strip()
+
+    @staticmethod
+    def _get_top_score(docs):
+        return max([doc.metadata.get("score", 0) for doc in docs], default=0)
 
 class BaseChatMemoryExtended(BaseChatMemory):
 
@@ -202,41 +1139,274 @@ class ConversationBufferWindowMemoryExtended(ConversationBufferWindowMemory, Bas
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-class ConversationSummaryMemoryExtended(ConversationSummaryMemory, BaseChatMemoryExtended, SummarizerMixin):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+def normalize_score(score, space_type, engine="nmslib"):
+    # Maps the k-NN plugin scores back to (1 + cosine) / 2 in [0, 1], so that thresholds mean the same thing whatever
+    # the index mapping. The l2 and inner product spaces assume unit-norm embeddings: GPT-J vectors are not, their
+    # scores collapse towards 0 and score_threshold / score_gap must stay off for such indexes
+    if space_type == "cosinesimil":
+        cosine = 2 * score - 1 if engine == "lucene" else 2 - 1 / score
+    elif space_type == "innerproduct":
+        cosine = score - 1 if score >= 1 else 1 - 1 / score
+    else:
+        # l2: score = 1 / (1 + d^2) and d^2 = 2 - 2 * cosine
+        cosine = 1 - (1 / score - 1) / 2
+
+    return min(max((1 + cosine) / 2, 0.0), 1.0)
 
 class DocumentRetrieverExtended(BaseRetriever):
-    def __init__(self, retriever, vector_field, text_field, k=3, return_source_documents=False, score_threshold=None, **kwargs):
+    # k is the maximum number of documents returned, out of the candidates fetched from OpenSearch. The candidates are
+    # cut at the first score under score_threshold (hybrid_score_threshold for fused hybrid scores) or at the first
+    # relative drop from the previous score above score_gap, min_results documents are always kept
+    def __init__(self, retriever, vector_field, text_field, k=3, return_source_documents=False, score_threshold=None,
+                 async_client=None, search_type="knn", hybrid_candidates=10, rrf_k=60, candidates=None, score_gap=None,
+                 min_results=1, space_type=None, tenancy="index", hybrid_score_threshold=None, **kwargs):
         self.k = k
+        self.tenancy = tenancy
+        self.candidates = max(candidates or k, k)
+        self.score_gap = score_gap
+        self.min_results = min_results
+        self.space_type = space_type
+        self.engine = "nmslib"
         self.vector_field = vector_field
         self.text_field = text_field
         self.return_source_documents = return_source_documents
         self.retriever = retriever
+        self.async_client = async_client
+        self.search_type = search_type
+        self.hybrid_candidates = hybrid_candidates
+        self.rrf_k = rrf_k
         self.filter = filter
         self.score_threshold = score_threshold
+        self.hybrid_score_threshold = hybrid_score_threshold
         self.kwargs = kwargs
 
     def get_relevant_documents(self, query: str) -> List[Document]:
+        if self.search_type == "hybrid":
+            embedding = self.retriever.embedding_function.embed_query(query)
+
+            with timed("opensearch_knn"):
+                response = self.retriever.client.msearch(body=self._get_hybrid_body(query, embedding))
+
+            return self._filter_documents(self._fuse_results(response), "rrf")
+
+        embedding = self.retriever.embedding_function.embed_query(query)
+
+        with timed("opensearch_knn"):
+            response = self.retriever.client.search(
+                index=self.retriever.index_name,
+                body=self._get_knn_body(embedding),
+                **self._get_routing()
+            )
+
+        return self._filter_documents(self._get_hits(response), self._get_space_type())
+
+    async def aget_relevant_documents(self, query: str) -> List[Document]:
+        if self.async_client is None:
+            return await asyncio.get_running_loop().run_in_executor(
+                None, contextvars.copy_context().run, self.get_relevant_documents, query
+            )
+
+        embedding = await self.retriever.embedding_function.aembed_query(query)
+
+        if self.search_type == "hybrid":
+            with timed("opensearch_knn"):
+                response = await self.async_client.msearch(body=self._get_hybrid_body(query, embedding))
+
+            return self._filter_documents(self._fuse_results(response), "rrf")
+
+        with timed("opensearch_knn"):
+            response = await self.async_client.search(
+                index=self.retriever.index_name,
+                body=self._get_knn_body(embedding),
+                **self._get_routing()
+            )
+
+        if self.space_type is None:
+            self._set_space_type(await self.async_client.indices.get_mapping(index=self.retriever.index_name))
+
+        return self._filter_documents(self._get_hits(response), self.space_type)
+
+    def _get_space_type(self):
+        # Read once from the index mapping, unless set in the configs
+        if self.space_type is None:
+            self._set_space_type(self.retriever.client.indices.get_mapping(index=self.retriever.index_name))
+
+        return self.space_type
+
+    def _set_space_type(self, mapping):
+        try:
+            field = next(iter(mapping.values()))["mappings"]["properties"][self.vector_field]
+        except (KeyError, StopIteration):
+            field = {}
+
+        method = field.get("method", {})
+        self.engine = method.get("engine", "nmslib")
+        self.space_type = method.get("space_type") or {
+            "cosine": "cosinesimil",
+            "dot_product": "innerproduct"
+        }.get(field.get("similarity"), "l2")
+
+        logger.info(f"Index {self.retriever.index_name} uses the {self.space_type} space ({self.engine})")
+
+    def _get_tenant(self):
+        return current_tenant.get() if self.tenancy == "shared" else None
+
+    def _get_routing(self):
+        # The indexing Lambdas route a tenant's documents to one shard, the search only visits that shard
+        tenant = self._get_tenant()
+
+        return {} if tenant is None else {"routing": tenant}
+
+    def _get_header(self):
+        return {"index": self.retriever.index_name, **self._get_routing()}
+
+    def _get_knn_body(self, embedding):
+        body = _default_approximate_search_query(embedding, k=self.candidates, vector_field=self.vector_field)
+        body["_source"] = {"excludes": [self.vector_field]}
+
+        tenant = self._get_tenant()
+
+        if tenant is not None:
+            # Efficient k-NN filtering (faiss and lucene engines): the filter is applied during the graph search, so the
+            # k results all belong to the tenant
+            body["query"]["knn"][self.vector_field]["filter"] = {"term": {"tenant": tenant}}
+
+        return body
+
+    def _get_hits(self, response):
+        return [
+            (
+                Document(page_content=hit["_source"][self.text_field], metadata=hit["_source"]),
+                hit["_score"]
+            )
+            for hit in response["hits"]["hits"][:self.candidates]
+        ]
+
+    def get_relevant_documents_batch(self, queries, embeddings):
+        # One _msearch round trip for all the queries of a batch
+        body = []
+
+        for query, embedding in zip(queries, embeddings):
+            if self.search_type == "hybrid":
+                body.extend(self._get_hybrid_body(query, embedding))
+            else:
+                body.extend([self._get_header(), self._get_knn_body(embedding)])
+
+        responses = self.retriever.client.msearch(body=body)["responses"]
+        per_query = 2 if self.search_type == "hybrid" else 1
         results = []
 
-        docs = self.retriever.similarity_search_with_score(query, k=self.k, vector_field=self.vector_field, text_field=self.text_field, **self.kwargs)
+        for i in range(len(queries)):
+            query_responses = {"responses": responses[i * per_query:(i + 1) * per_query]}
+
+            if self.search_type == "hybrid":
+                results.append(self._filter_documents(self._fuse_results(query_responses), "rrf"))
+            else:
+                if "error" in query_responses["responses"][0]:
+                    raise ValueError(f"Error raised by OpenSearch: {query_responses['responses'][0]['error']}")
 
-        if docs:
-            for doc in docs:
-                metadata = doc[0].metadata
-                metadata["score"] = doc[1]
-                if self.score_threshold is None or \
-                        (self.score_threshold is not None and metadata["score"] >= self.score_threshold):
-                    results.append(Document(
-                        page_content=doc[0].page_content,
-                        metadata=metadata
-                    ))
+                results.append(self._filter_documents(self._get_hits(query_responses["responses"][0]), self._get_space_type()))
 
         return results
 
-    async def aget_relevant_documents(self, query: str) -> List[Document]:
-        return await super().aget_relevant_documents(query)
+    def _get_hybrid_body(self, query, embedding):
+        # One _msearch round trip: BM25 on the passage and file name, kNN on the embedding
+        header = self._get_header()
+        source = {"excludes": [self.vector_field]}
+        tenant = self._get_tenant()
+
+        lexical_query = {
+            "size": self.hybrid_candidates,
+            "_source": source,
+            "query": {
+                "multi_match": {
+                    "query": query,
+                    "fields": [self.text_field, "file_name"]
+                }
+            }
+        }
+
+        vector_query = {
+            "size": self.hybrid_candidates,
+            "_source": source,
+            "query": {
+                "knn": {
+                    self.vector_field: {
+                        "vector": embedding,
+                        "k": self.hybrid_candidates
+                    }
+                }
+            }
+        }
+
+        if tenant is not None:
+            lexical_query["query"] = {"bool": {"must": lexical_query["query"], "filter": {"term": {"tenant": tenant}}}}
+            vector_query["query"]["knn"][self.vector_field]["filter"] = {"term": {"tenant": tenant}}
+
+        return [header, lexical_query, header, vector_query]
+
+    def _fuse_results(self, response):
+        # Reciprocal rank fusion: score(d) = sum over the result lists of 1 / (rrf_k + rank of d)
+        scores = {}
+        hits = {}
+
+        for result in response["responses"]:
+            if "error" in result:
+                raise ValueError(f"Error raised by OpenSearch: {result['error']}")
+
+            for rank, hit in enumerate(result["hits"]["hits"], start=1):
+                scores[hit["_id"]] = scores.get(hit["_id"], 0) + 1 / (self.rrf_k + rank)
+                hits.setdefault(hit["_id"], hit)
+
+        ranked = sorted(scores, key=scores.get, reverse=True)[:self.candidates]
+
+        return [
+            (
+                Document(page_content=hits[doc_id]["_source"][self.text_field], metadata=hits[doc_id]["_source"]),
+                scores[doc_id]
+            )
+            for doc_id in ranked
+        ]
+
+    def _normalize_score(self, score, space_type):
+        if space_type == "rrf":
+            # Fraction of the best possible fused score, first in both result lists
+            return score * (self.rrf_k + 1) / 2
+
+        return normalize_score(score, space_type, self.engine)
+
+    def _filter_documents(self, docs, space_type):
+        results = []
+        previous_score = None
+        # A fused score of 0.5 is a document ranked first in one list only, it has its own scale
+        score_threshold = self.hybrid_score_threshold if space_type == "rrf" else self.score_threshold
+
+        for doc, raw_score in docs:
+            if len(results) >= self.k:
+                break
+
+            score = self._normalize_score(raw_score, space_type)
+
+            if len(results) >= self.min_results:
+                if score_threshold is not None and score < score_threshold:
+                    break
+
+                # Elbow: the remaining candidates are much less relevant than the ones kept so far
+                if self.score_gap is not None and previous_score is not None and \
+                        previous_score - score > self.score_gap * previous_score:
+                    break
+
+            # The sources and the condense comparison read the raw score, the normalized one is for the cut-offs only
+            metadata = doc.metadata
+            metadata["score"] = raw_score
+            metadata["normalized_score"] = score
+            results.append(Document(
+                page_content=doc.page_content,
+                metadata=metadata
+            ))
+            previous_score = score
+
+        return results
 
 class FalconHandler(LLMContentHandler):
     content_type = "application/json"
@@ -244,6 +1414,16 @@ class FalconHandler(LLMContentHandler):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        # The handler is shared by the cached chains, concurrent calls must not see each other's prompt length
+        self.local = threading.local()
+
+    @property
+    def len_prompt(self):
+        return self.local.len_prompt
+
+    @len_prompt.setter
+    def len_prompt(self, value):
+        self.local.len_prompt = value
 
     def transform_input(self, prompt: str, model_kwargs: dict) -> bytes:
         self.len_prompt = len(prompt)
@@ -258,6 +1438,115 @@ class FalconHandler(LLMContentHandler):
         ans = ans[:ans.rfind("Human")].strip()
         return ans
 
+    def transform_stream_input(self, prompt: str, model_kwargs: dict) -> bytes:
+        input_str = json.dumps({"inputs": prompt,
+                                "parameters": model_kwargs,
+                                "stream": True})
+        return input_str.encode('utf-8')
+
+    def transform_stream_output(self, event_stream):
+        # TGI sends server-sent events ("data:{...}") that can be split across payload parts
+        buffer = ""
+
+        for event in event_stream:
+            if "PayloadPart" not in event:
+                continue
+
+            buffer += event["PayloadPart"]["Bytes"].decode("utf-8")
+
+            while "\n" in buffer:
+                line, buffer = buffer.split("\n", 1)
+
+                if line.startswith("data:"):
+                    token = json.loads(line[len("data:"):])["token"]
+
+                    if not token.get("special", False):
+                        yield token["text"]
+
+class SagemakerEndpointExtended(SagemakerEndpoint):
+    streaming: bool = False
+
+    def _call(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+    ) -> str:
+        metrics = current_metrics.get()
+
+        # The condensing call is already accounted as query_condense
+        if metrics is None or "query_condense" in metrics.active:
+            return self._generate_text(prompt, stop, run_manager)
+
+        with metrics.stage("llm_generation"):
+            return self._generate_text(prompt, stop, run_manager)
+
+    def _generate_text(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+    ) -> str:
+        if not self.streaming:
+            return super()._call(prompt, stop, run_manager)
+
+        _model_kwargs = self.model_kwargs or {}
+        _endpoint_kwargs = self.endpoint_kwargs or {}
+
+        response = self.client.invoke_endpoint_with_response_stream(
+            EndpointName=self.endpoint_name,
+            Body=self.content_handler.transform_stream_input(prompt, _model_kwargs),
+            ContentType=self.content_handler.content_type,
+            Accept=self.content_handler.accepts,
+            **_endpoint_kwargs
+        )
+
+        # Falcon keeps going with the next "Human" turn, the generation stops as soon as it starts
+        stop_word = "Human"
+        text = ""
+        sent = 0
+
+        for token in self.content_handler.transform_stream_output(response["Body"]):
+            text += token
+
+            if stop_word in text:
+                text = text[:text.find(stop_word)]
+                break
+
+            # A tail that may be the beginning of the stop word is held back until the next tokens settle it
+            held = next((n for n in range(min(len(stop_word) - 1, len(text)), 0, -1) if stop_word.startswith(text[-n:])), 0)
+
+            if run_manager and len(text) - held > sent:
+                run_manager.on_llm_new_token(text[sent:len(text) - held])
+                sent = len(text) - held
+
+        if run_manager and len(text) > sent:
+            run_manager.on_llm_new_token(text[sent:])
+
+        return text.strip()
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+    ) -> str:
+        # boto3 is blocking, the whole call runs in one executor thread so the content handler state stays consistent
+        metrics = current_metrics.get()
+
+        if metrics is None or "query_condense" in metrics.active:
+            return await asyncio.get_running_loop().run_in_executor(None, partial(self._generate_text, prompt, stop))
+
+        with metrics.stage("llm_generation"):
+            return await asyncio.get_running_loop().run_in_executor(None, partial(self._generate_text, prompt, stop))
+
+class StreamingQueueCallbackHandler(BaseCallbackHandler):
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        self.tokens.put(token)
+
 class GPTJHandler(EmbeddingsContentHandler):
     content_type = "application/json"
     accepts = "application/json"
@@ -274,62 +1563,346 @@ class GPTJHandler(EmbeddingsContentHandler):
         response = json.loads(results)
         return response["embedding"]
 
-def lambda_handler(event, context):
-    try:
-
+registry.register_content_handler("FalconHandler", FalconHandler)
+registry.register_content_handler("GPTJHandler", GPTJHandler)
+registry.register_template("falcon_template", falcon_template)
+registry.register_variant("chatbot", [
+    {
+        "key": "The AI keeps the answer conversational and provides lots of specific details from its context.",
+        "value": "The AI keeps the answer conversational and provides lots of specific details from its context. Please keep the answer in 50 words or less."
+    },
+    {
+        "key": "Use the following pieces of context to answer the question at the end.",
+        "value": "Use the following pieces of context to answer the question at the end. Please keep the answer in 50 words or less."
+    }
+])
+
+def get_sources(answer):
+    sources = []
+
+    if len(answer.get("source_documents", [])) > 0:
+        for el in answer.get("source_documents"):
+            sources.append({
+                "image": el.metadata["image"] if "image" in el.metadata else "",
+                "details": f'Document = {el.metadata["file_name"]} | Page = {el.metadata["page"]} | Score = {el.metadata["score"]}',
+                "passage": (el.page_content[:300] + '..') if len(el.page_content) > 300 else el.page_content
+            })
+
+    return sources
+
+def get_result(answer):
+    if "answer" not in answer and "text" in answer:
+        answer["answer"] = answer["text"]
+
+    return {
+        "answer": answer.get("answer").strip(),
+        "sources": get_sources(answer)
+    }
+
+def stream_answer(qa, inputs):
+    # Frames: {"type": "token", "text": ...} while Falcon generates, then one {"type": "answer", ...} with the sources
+    tokens = queue.Queue()
+    outputs = {}
+
+    def run():
+        try:
+            outputs["answer"] = qa(inputs, callbacks=[StreamingQueueCallbackHandler(tokens)])
+        except Exception as e:
+            outputs["error"] = e
+        finally:
+            tokens.put(None)
+
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(run,))
+    thread.start()
+
+    while True:
+        token = tokens.get()
+
+        if token is None:
+            break
+
+        yield {"type": "token", "text": token}
+
+    thread.join()
+
+    if "error" in outputs:
+        raise outputs["error"]
+
+    yield {"type": "answer", **get_result(outputs["answer"])}
+
+def answer_frames(event):
+    with timed("config_load"):
         config = read_configs(bucket, config_file)
 
-        logger.info(event)
+    logger.info(event)
+    logger.info(f"Config cache: {config_cache.stats()}")
+    logger.info(f"Embedding cache: {embedding_cache.stats()}")
+    logger.info(f"Answer cache: {answer_cache.stats()}")
 
-        user = event["user"]
-        question = event["question"]
-        chat_memory = event["chat_memory"]
-        llm_endpoint = event["llm_endpoint"]
-        embeddings_endpoint = event["embeddings_endpoint"]
-        selected_type = event["selected_type"]
+    user = event["user"]
+    question = event["question"]
+    llm_endpoint = event["llm_endpoint"]
+    embeddings_endpoint = event["embeddings_endpoint"]
+    selected_type = event["selected_type"]
+    streaming = event.get("stream", False)
 
-        history = ChatMessageHistory()
+    chat_memory = get_chat_memory(event, config["llms"][llm_endpoint]["memory_window"])
+    history = get_history(chat_memory)
 
-        for message in chat_memory:
-            history.add_user_message(message[0])
-            history.add_ai_message(message[1])
+    set_tenant(config, user)
 
-        if user != "":
-            config["es_credentials"]["index"] = config["es_credentials"]["index"] + "-" + user
+    with timed("chain_build"):
+        chain = get_chain(config, embeddings_endpoint, llm_endpoint, selected_type)
 
-        if selected_type == "Chat Q&A":
-            chain = ChatQAChain(embeddings_endpoint, llm_endpoint)
-        else:
-            chain = ChatbotChain(embeddings_endpoint, llm_endpoint)
+    # Semantic answer cache, only for questions without chat history
+    answer_cache_threshold = config["llms"][llm_endpoint].get("answer_cache_threshold")
+    use_answer_cache = answer_cache_threshold is not None and len(chat_memory) == 0
 
-        qa = chain.build(config, history)
+    if use_answer_cache:
+        index_name = config["es_credentials"]["index"]
+        cache_key = (index_name, current_tenant.get(), llm_endpoint, selected_type)
+        generation = answer_cache.get_generation(chain.vector_search.client, index_name, current_tenant.get())
+        question_embedding = chain.embeddings.embed_query(question)
 
-        sources = []
+        cached_answer = answer_cache.lookup(cache_key, generation, question_embedding, answer_cache_threshold)
+        add_metric("answer_cache_hit", int(cached_answer is not None))
 
-        answer = qa({"question": question, "chat_history": chat_memory})
+        if cached_answer is not None:
+            save_turn(event, cached_answer)
 
-        if len(answer.get("source_documents", [])) > 0:
-            for el in answer.get("source_documents"):
-                sources.append({
-                    "image": el.metadata["image"] if "image" in el.metadata else "",
-                    "details": f'Document = {el.metadata["file_name"]} | Page = {el.metadata["page"]} | Score = {el.metadata["score"]}',
-                    "passage": (el.page_content[:300] + '..') if len(el.page_content) > 300 else el.page_content
-                })
+            yield {"type": "answer", **cached_answer}
+            return
 
-                if len(sources) == 3:
-                    break
+    qa = chain.with_memory(history, streaming=streaming)
+    inputs = {"question": question, "chat_history": chat_memory}
+
+    if streaming:
+        for frame in stream_answer(qa, inputs):
+            if frame["type"] != "answer":
+                yield frame
+
+        result = {"answer": frame["answer"], "sources": frame["sources"]}
+    else:
+        result = get_result(qa(inputs))
+
+    if use_answer_cache:
+        answer_cache.add(cache_key, generation, question_embedding, result)
+
+    save_turn(event, result)
+
+    yield {"type": "answer", **result}
+
+async def aget_answer(event):
+    loop = asyncio.get_running_loop()
+
+    with timed("config_load"):
+        config = await loop.run_in_executor(None, read_configs, bucket, config_file)
+
+    logger.info(event)
+
+    user = event["user"]
+    question = event["question"]
+    llm_endpoint = event["llm_endpoint"]
+    embeddings_endpoint = event["embeddings_endpoint"]
+    selected_type = event["selected_type"]
+
+    set_tenant(config, user)
+
+    with timed("chain_build"):
+        chain = get_chain(config, embeddings_endpoint, llm_endpoint, selected_type)
+
+    index_name = config["es_credentials"]["index"]
+    cache_key = (index_name, current_tenant.get(), llm_endpoint, selected_type)
+    answer_cache_threshold = config["llms"][llm_endpoint].get("answer_cache_threshold")
+
+    # Loading the history and the index generation are independent, run them concurrently
+    tasks = [loop.run_in_executor(None, get_chat_memory, event, config["llms"][llm_endpoint]["memory_window"])]
+
+    if answer_cache_threshold is not None:
+        tasks.append(loop.run_in_executor(None, answer_cache.get_generation, chain.vector_search.client, index_name,
+                                          current_tenant.get()))
+
+    chat_memory, *cache_inputs = await asyncio.gather(*tasks)
+
+    # The cache only serves questions without history, a follow-up turn does not pay the embedding call
+    use_answer_cache = answer_cache_threshold is not None and len(chat_memory) == 0
+
+    if use_answer_cache:
+        generation = cache_inputs[0]
+        question_embedding = await chain.embeddings.aembed_query(question)
+
+        cached_answer = answer_cache.lookup(cache_key, generation, question_embedding, answer_cache_threshold)
+        add_metric("answer_cache_hit", int(cached_answer is not None))
+
+        if cached_answer is not None:
+            await loop.run_in_executor(None, save_turn, event, cached_answer)
+
+            return cached_answer
+
+    qa = chain.with_memory(get_history(chat_memory))
+
+    result = get_result(await qa.acall({"question": question, "chat_history": chat_memory}))
+
+    if use_answer_cache:
+        answer_cache.add(cache_key, generation, question_embedding, result)
+
+    await loop.run_in_executor(None, save_turn, event, result)
+
+    return result
+
+def answer_batch(event):
+    # Batch mode for offline jobs: one embedding call, one _msearch, then the generations with bounded concurrency
+    questions = event["questions"]
 
-        if "answer" not in answer and "text" in answer:
-            answer["answer"] = answer["text"]
+    if not isinstance(questions, list) or not all(isinstance(question, str) for question in questions):
+        raise ValueError("questions must be a list of strings")
+
+    if not questions:
+        logger.info("Empty batch, nothing to answer")
+
+        return ""
+
+    config = read_configs(bucket, config_file)
+
+    user = event["user"]
+    llm_endpoint = event["llm_endpoint"]
+    embeddings_endpoint = event["embeddings_endpoint"]
+    selected_type = event["selected_type"]
+    max_concurrency = event.get("max_concurrency", batch_concurrency)
+
+    logger.info(f"Batch of {len(questions)} questions with concurrency {max_concurrency}")
+
+    set_tenant(config, user)
+
+    chain = get_chain(config, embeddings_endpoint, llm_endpoint, selected_type)
+
+    start = time.perf_counter()
+    # LangChain sends 64 texts per request by default, the whole batch goes in one
+    embeddings = chain.embeddings.embed_documents(questions, chunk_size=len(questions))
+    embedding_ms = round((time.perf_counter() - start) * 1000, 2)
+
+    for question, embedding in zip(questions, embeddings):
+        embedding_cache.put(chain.embeddings.endpoint_name, question, embedding)
+
+    start = time.perf_counter()
+    batch_docs = chain.retriever.get_relevant_documents_batch(questions, embeddings)
+    search_ms = round((time.perf_counter() - start) * 1000, 2)
+
+    def generate(question, docs):
+        start = time.perf_counter()
+
+        docs = pack_documents(docs, chain.qa.context_token_budget, chain.qa.dedup_threshold)
+        answer = chain.qa.combine_docs_chain.run(input_documents=docs, question=question, chat_history="")
+
+        return {
+            "question": question,
+            "answer": answer.strip(),
+            "sources": get_sources({"source_documents": docs}),
+            "timings": {
+                "embedding_ms": embedding_ms,
+                "search_ms": search_ms,
+                "generation_ms": round((time.perf_counter() - start) * 1000, 2)
+            }
+        }
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = [executor.submit(generate, question, docs) for question, docs in zip(questions, batch_docs)]
+
+    results = []
+
+    # A failed generation is reported on its own line, the answers of the other questions are kept
+    for question, future in zip(questions, futures):
+        try:
+            results.append(future.result())
+        except Exception as e:
+            logger.error(f"Batch generation failed for {question!r}: {traceback.format_exc()}")
+
+            results.append({"question": question, "error": f"{type(e).__name__}: {e}"})
+
+    return "\n".join(json.dumps(result) for result in results)
+
+def get_request_metrics(event):
+    metrics = Metrics({
+        "selected_type": event.get("selected_type", ""),
+        "llm_endpoint": event.get("llm_endpoint", "")
+    })
+    metrics.add("request_bytes", len(json.dumps(event)))
+
+    return metrics
+
+def stream_response(event):
+    # Body of a "stream": true request, one JSON line per frame: token frames then the answer. stream_runtime.py sends
+    # every line as soon as it is yielded, the managed runtime returns them all at once through lambda_handler
+    metrics = get_request_metrics(event)
+    metrics_token = current_metrics.set(metrics)
+    response_bytes = 0
+
+    try:
+        for frame in answer_frames(event):
+            line = json.dumps(frame) + "\n"
+            response_bytes += len(line)
+
+            if frame["type"] == "token" and "first_frame" not in metrics.timings:
+                metrics.add_timing("first_frame", (time.perf_counter() - metrics.start) * 1000)
+
+            yield line
+
+        metrics.add("response_bytes", response_bytes)
+
+        # In debug mode the per-stage metrics are sent in a last frame
+        if event.get("debug", False):
+            yield json.dumps({"type": "metrics", **metrics.to_dict()}) + "\n"
+    finally:
+        current_metrics.reset(metrics_token)
+        metrics_sink.emit(metrics)
+
+def lambda_handler(event, context):
+    try:
+        # Deployment hook: {"action": "invalidate_configs"} drops the cached configs and chains
+        if event.get("action") == "invalidate_configs":
+            return {
+                'statusCode': 200,
+                'body': json.dumps(invalidate_configs())
+            }
+
+        # Batch mode: {"action": "batch", "questions": [...], ...}, the body is one JSON line per question
+        if event.get("action") == "batch":
+            return {
+                'statusCode': 200,
+                'body': answer_batch(event)
+            }
+
+        # Without stream_runtime.py the frames of a "stream": true request are returned together in one body
+        if event.get("stream", False):
+            return {
+                'statusCode': 200,
+                'body': "".join(stream_response(event)).rstrip("\n")
+            }
+
+        metrics = get_request_metrics(event)
+        metrics_token = current_metrics.set(metrics)
+        debug = event.get("debug", False)
+
+        try:
+            if backend_async:
+                result = event_loop.run_until_complete(aget_answer(event))
+            else:
+                for frame in answer_frames(event):
+                    if frame["type"] == "answer":
+                        result = {"answer": frame["answer"], "sources": frame["sources"]}
+
+            with timed("response_serialization"):
+                # In debug mode the per-stage metrics collected so far are returned with the answer
+                body = json.dumps({**result, "metrics": metrics.to_dict()} if debug else result)
+
+            metrics.add("response_bytes", len(body))
+        finally:
+            current_metrics.reset(metrics_token)
+            metrics_sink.emit(metrics)
 
         return {
             'statusCode': 200,
-            'body': json.dumps(
-                {
-                    "answer": answer.get("answer").strip(),
-                    "sources": sources
-                }
-            )
+            'body': body
         }
 
     except Exception as e:
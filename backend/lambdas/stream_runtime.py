@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+import base64
+import http.client
+import importlib
+import json
+import logging
+import os
+import sys
+import time
+import traceback
+
+# Lambda Runtime API client that streams the answer frames of the backend: the managed Python runtime only returns a
+# response once the handler returned, so the tokens of a "stream": true request would all arrive with the final answer.
+#
+# It replaces the managed runtime client through the exec wrapper of the function, with the managed Python
+# interpreter and the function code unchanged:
+#
+#   AWS_LAMBDA_EXEC_WRAPPER=/var/task/stream_runtime.py      the file must be executable in the deployment zip
+#
+# A "stream": true event is answered with the lines of handler.stream_response as they are generated, to be read with
+# InvokeWithResponseStream. Any other event goes through _HANDLER (handler.lambda_handler) and is returned at once.
+
+logger = logging.getLogger(__name__)
+if len(logging.getLogger().handlers) > 0:
+    logging.getLogger().setLevel(logging.INFO)
+else:
+    logging.basicConfig(level=logging.INFO)
+
+runtime_api = os.getenv("AWS_LAMBDA_RUNTIME_API")
+api_version = "2018-06-01"
+
+class LambdaContext:
+    def __init__(self, headers):
+        self.aws_request_id = headers.get("Lambda-Runtime-Aws-Request-Id")
+        self.invoked_function_arn = headers.get("Lambda-Runtime-Invoked-Function-Arn")
+        self.function_name = os.getenv("AWS_LAMBDA_FUNCTION_NAME")
+        self.function_version = os.getenv("AWS_LAMBDA_FUNCTION_VERSION")
+        self.memory_limit_in_mb = os.getenv("AWS_LAMBDA_FUNCTION_MEMORY_SIZE")
+        self.log_group_name = os.getenv("AWS_LAMBDA_LOG_GROUP_NAME")
+        self.log_stream_name = os.getenv("AWS_LAMBDA_LOG_STREAM_NAME")
+        self.deadline_ms = int(headers.get("Lambda-Runtime-Deadline-Ms", 0))
+
+    def get_remaining_time_in_ms(self):
+        return max(self.deadline_ms - int(time.time() * 1000), 0)
+
+def get_error(e):
+    return {
+        "errorMessage": str(e),
+        "errorType": type(e).__name__,
+        "stackTrace": traceback.format_exception(type(e), e, e.__traceback__)
+    }
+
+def post(connection, path, body, headers=None):
+    connection.request("POST", f"/{api_version}/runtime/{path}", body=json.dumps(body), headers=headers or {})
+    response = connection.getresponse()
+    response.read()
+
+    if response.status != 202:
+        logger.error(f"Runtime API answered {response.status} to {path}")
+
+def post_error(connection, path, e):
+    post(connection, path, get_error(e), {"Lambda-Runtime-Function-Error-Type": f"Runtime.{type(e).__name__}"})
+
+def post_stream(connection, request_id, lines):
+    # Chunked body: one chunk per frame. An error raised after the first chunk is reported in the trailers
+    connection.putrequest("POST", f"/{api_version}/runtime/invocation/{request_id}/response")
+    connection.putheader("Lambda-Runtime-Function-Response-Mode", "streaming")
+    connection.putheader("Content-Type", "application/x-ndjson")
+    connection.putheader("Transfer-Encoding", "chunked")
+    connection.putheader("Trailer", "Lambda-Runtime-Function-Error-Type, Lambda-Runtime-Function-Error-Body")
+    connection.endheaders()
+
+    trailers = b""
+
+    try:
+        for line in lines:
+            data = line.encode("utf-8")
+            connection.send(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+    except Exception as e:
+        logger.error(traceback.format_exc())
+
+        error_body = base64.b64encode(json.dumps(get_error(e)).encode("utf-8")).decode("ascii")
+        trailers = (f"Lambda-Runtime-Function-Error-Type: Runtime.{type(e).__name__}\r\n"
+                    f"Lambda-Runtime-Function-Error-Body: {error_body}\r\n").encode("ascii")
+
+    connection.send(b"0\r\n" + trailers + b"\r\n")
+
+    response = connection.getresponse()
+    response.read()
+
+    if response.status != 202:
+        logger.error(f"Runtime API answered {response.status} to the streamed response of {request_id}")
+
+def load_handler(connection):
+    # _HANDLER is module.function, the module is imported from the function code directory
+    module_name, function_name = os.getenv("_HANDLER", "handler.lambda_handler").rsplit(".", 1)
+    sys.path.insert(0, os.getenv("LAMBDA_TASK_ROOT", "/var/task"))
+
+    try:
+        module = importlib.import_module(module_name)
+
+        return module, getattr(module, function_name)
+    except Exception as e:
+        logger.error(traceback.format_exc())
+        post_error(connection, "init/error", e)
+
+        sys.exit(1)
+
+def run():
+    connection = http.client.HTTPConnection(runtime_api)
+    module, handler = load_handler(connection)
+
+    while True:
+        connection.request("GET", f"/{api_version}/runtime/invocation/next")
+        response = connection.getresponse()
+        event = json.loads(response.read())
+        headers = response.headers
+        request_id = headers.get("Lambda-Runtime-Aws-Request-Id")
+
+        if "Lambda-Runtime-Trace-Id" in headers:
+            os.environ["_X_AMZN_TRACE_ID"] = headers["Lambda-Runtime-Trace-Id"]
+
+        if isinstance(event, dict) and event.get("stream", False) and hasattr(module, "stream_response"):
+            post_stream(connection, request_id, module.stream_response(event))
+
+            continue
+
+        try:
+            result = handler(event, LambdaContext(headers))
+        except Exception as e:
+            post_error(connection, f"invocation/{request_id}/error", e)
+
+            continue
+
+        post(connection, f"invocation/{request_id}/response", result)
+
+if __name__ == "__main__":
+    run()
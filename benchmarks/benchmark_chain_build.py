@@ -0,0 +1,70 @@
+import os
+import statistics
+import sys
+import time
+import yaml
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend", "lambdas"))
+
+import handler
+
+ITERATIONS = int(os.getenv("ITERATIONS", default=200))
+
+def load_config():
+    with open(os.path.join(os.path.dirname(__file__), "..", "backend", "configs.yaml"), "r") as file:
+        config = yaml.safe_load(file)
+
+    config["es_credentials"]["endpoint"] = "http://localhost:9200"
+
+    return config
+
+def legacy_prompt(config, llm_endpoint, replace_strings):
+    # What Chain.build did on every request before the registry
+    handler_class = eval(config["llms"][llm_endpoint]["content_handler"], vars(handler))
+    handler_class()
+
+    prompt_template = eval(config["llms"][llm_endpoint]["template"], vars(handler))
+
+    for item in replace_strings:
+        prompt_template = prompt_template.replace(item["key"], item["value"])
+
+    return handler.PromptTemplate(
+        template=prompt_template, input_variables=["context", "question", "chat_history"]
+    )
+
+def registry_prompt(config, llm_endpoint, variant):
+    handler.registry.get_content_handler(config["llms"][llm_endpoint]["content_handler"])
+
+    return handler.registry.get_prompt(config["llms"][llm_endpoint]["template"], variant)
+
+def measure(name, function):
+    timings = []
+
+    for _ in range(ITERATIONS):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+
+    print(f"{name:<40} mean={statistics.mean(timings):8.4f} ms  p50={timings[len(timings) // 2]:8.4f} ms  "
+          f"p95={timings[int(len(timings) * 0.95)]:8.4f} ms")
+
+if __name__ == "__main__":
+    config = load_config()
+    llm_endpoint = next(iter(config["llms"]))
+    embeddings_endpoint = next(iter(config["embeddings"]))
+    replace_strings = handler.registry.variants["chatbot"]
+
+    def cold_build():
+        handler.registry.clear()
+        handler.ChatbotChain(embeddings_endpoint, llm_endpoint).build(config)
+
+    def warm_build():
+        handler.ChatbotChain(embeddings_endpoint, llm_endpoint).build(config)
+
+    measure("handler + prompt, eval (before)", lambda: legacy_prompt(config, llm_endpoint, replace_strings))
+    measure("handler + prompt, registry (after)", lambda: registry_prompt(config, llm_endpoint, "chatbot"))
+    measure("ChatbotChain.build, cold registry", cold_build)
+    measure("ChatbotChain.build, warm registry", warm_build)
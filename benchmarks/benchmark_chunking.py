@@ -0,0 +1,152 @@
+import argparse
+import json
+import random
+import re
+import sys
+import textwrap
+import time
+
+from benchmark_e2e import ROOT_DIR, get_page, load_module
+
+# Throughput and chunk parity of the token chunker of the indexing Lambdas against the former character splitter.
+#
+#   python benchmarks/benchmark_chunking.py                  4 MB of wrapped, hyphenated text
+#   python benchmarks/benchmark_chunking.py --size-mb 16
+#
+# The reference is the former path: three re.sub passes then LangChain's RecursiveCharacterTextSplitter with 768
+# characters and an overlap of 200, on the same windows. The exit code is 1 when the token chunker is slower, when
+# the chunk counts differ by more than --tolerance or when a chunk exceeds CHUNK_SIZE tokens.
+# tiktoken needs its cl100k_base file, set TIKTOKEN_CACHE_DIR to a populated cache on machines without network.
+
+def get_text(size_mb, seed):
+    # Pages as extracted from a PDF: lines of about 80 characters, some words hyphenated at the line end
+    rng = random.Random(seed)
+    pages = []
+    size = 0
+
+    while size < size_mb * 1024 * 1024:
+        lines = []
+
+        for paragraph in get_page(rng, 3000).split("\n\n"):
+            for line in textwrap.wrap(paragraph, 80):
+                if rng.random() < 0.1:
+                    line = line + " inter-\nnational"
+
+                lines.append(line)
+
+            lines.append("")
+
+        pages.append("\n".join(lines))
+        size += len(pages[-1])
+
+    return "\n\n".join(pages)
+
+def reference_chunks(module, text):
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=768,
+        separators=["\n\n", "\n", ".", "!", "?", ",", " ", ""],
+        chunk_overlap=200,
+    )
+
+    for doc in module.get_windows([text], module.text_window_chars):
+        doc = re.sub(r"(\w)-\n(\w)", r"\1\2", doc)
+        doc = re.sub(r"(?<!\n)\n(?!\n)", " ", doc)
+        doc = re.sub(r"\n{2,}", "\n", doc)
+
+        yield from text_splitter.split_text(doc)
+
+def token_chunks(module, text):
+    for doc in module.get_windows([text], module.text_window_chars):
+        yield from module.split_text(module.normalize_text(doc))
+
+def measure(function, module, text, repeats):
+    best = None
+
+    for _ in range(repeats):
+        start = time.perf_counter()
+        chunks = list(function(module, text))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tokens = [len(module.get_encoding().encode_ordinary(chunk)) for chunk in chunks]
+
+    return {
+        "chunks": len(chunks),
+        "mb_per_s": round(len(text) / 1024 / 1024 / best, 2),
+        "avg_tokens": round(sum(tokens) / len(tokens), 1),
+        "max_tokens": max(tokens),
+        "avg_chars": round(sum(len(chunk) for chunk in chunks) / len(chunks), 1)
+    }
+
+def run(args):
+    module = load_module(
+        "benchmark_lambda_index_txt", f"{ROOT_DIR}/data_workflow/lambdas/lambda_index_txt/handler.py"
+    )
+    text = get_text(args.size_mb, args.seed)
+
+    # Lazy imports and the tokenizer are loaded before measuring
+    list(reference_chunks(module, text[:10000]))
+    list(token_chunks(module, text[:10000]))
+
+    results = {
+        "reference": measure(reference_chunks, module, text, args.repeats),
+        "token": measure(token_chunks, module, text, args.repeats)
+    }
+    results["chunk_ratio"] = round(results["token"]["chunks"] / results["reference"]["chunks"], 3)
+    results["speedup"] = round(results["token"]["mb_per_s"] / results["reference"]["mb_per_s"], 2)
+    results["chunk_size"] = module.CHUNK_SIZE
+
+    for name in ["reference", "token"]:
+        result = results[name]
+        print(name.ljust(12) + f"{result['mb_per_s']:8.2f} MB/s  {result['chunks']:7d} chunks  "
+              f"{result['avg_tokens']:6.1f} avg / {result['max_tokens']:4d} max tokens  {result['avg_chars']:6.1f} avg chars")
+
+    print(f"speedup {results['speedup']}x, chunk ratio {results['chunk_ratio']}")
+
+    return results
+
+def check(results, tolerance):
+    failures = []
+
+    if results["speedup"] < 1:
+        failures.append(f"token chunker slower than the reference: {results['speedup']}x")
+
+    if abs(results["chunk_ratio"] - 1) > tolerance:
+        failures.append(f"chunk count ratio {results['chunk_ratio']} outside 1 +/- {tolerance}")
+
+    if results["token"]["max_tokens"] > results["chunk_size"]:
+        failures.append(f"chunk of {results['token']['max_tokens']} tokens above {results['chunk_size']}")
+
+    return failures
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Token chunker against the former character splitter")
+    parser.add_argument("--size-mb", type=float, default=4)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Accepted deviation of the chunk count ratio")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=None, help="Also write the results to this JSON file")
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = get_args()
+    results = run(args)
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    failures = check(results, args.tolerance)
+
+    if failures:
+        print("Failures:")
+
+        for failure in failures:
+            print(f"  {failure}")
+
+        sys.exit(1)
+
+    print("Chunking parity")
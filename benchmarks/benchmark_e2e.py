@@ -0,0 +1,488 @@
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import yaml
+
+# Offline end-to-end benchmark of the backend and of the indexing Lambdas against the in-process fakes.
+#
+#   python benchmarks/benchmark_e2e.py                       run and compare with benchmarks/baseline.json
+#   python benchmarks/benchmark_e2e.py --update-baseline     run and store the results as the new baseline
+#
+# The exit code is 1 when a scenario regressed by more than --tolerance against the baseline or is missing from it.
+# tiktoken needs its cl100k_base file, set TIKTOKEN_CACHE_DIR to a populated cache on machines without network.
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.join(BENCHMARKS_DIR, "..")
+BASELINE_PATH = os.path.join(BENCHMARKS_DIR, "baseline.json")
+
+BUCKET = "benchmark-bucket"
+CONFIG_KEY = "configs.yaml"
+ES_URL = "http://opensearch.local"
+ES_INDEX_NAME = "benchmark"
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "eu-west-1")
+os.environ.setdefault("s3_bucket", BUCKET)
+os.environ.setdefault("genai_configs", CONFIG_KEY)
+os.environ.setdefault("ES_URL", ES_URL)
+os.environ.setdefault("ES_INDEX_NAME", ES_INDEX_NAME)
+os.environ.setdefault("SAGEMAKER_ENDPOINT", "gpt-j-embeddings")
+os.environ.setdefault("METRICS_SINK", "none")
+
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import fakes
+
+WORDS = (
+    "amazon bedrock sagemaker opensearch lambda index vector embedding passage document retrieval question "
+    "answer model endpoint latency throughput region bucket object textract page table chunk token prompt "
+    "context history session memory stream batch cache config deployment instance cluster shard replica "
+    "policy role permission network subnet gateway function runtime layer package dependency"
+).split()
+
+def percentile(values, q):
+    values = sorted(values)
+
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+def summarize(latencies, items, elapsed, unit):
+    return {
+        "n": len(latencies),
+        "throughput": round(items / elapsed, 3),
+        "unit": unit,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3)
+    }
+
+def get_sentence(rng, length=12):
+    return " ".join(rng.choice(WORDS) for _ in range(length)).capitalize() + "."
+
+def get_page(rng, chars):
+    sentences = []
+    size = 0
+
+    while size < chars:
+        sentence = get_sentence(rng, rng.randint(6, 18))
+        sentences.append(sentence)
+        size += len(sentence) + 1
+
+        if rng.random() < 0.1:
+            sentences.append("\n\n")
+
+    return " ".join(sentences)
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    # pydantic resolves the model annotations through sys.modules
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+
+    return module
+
+def load_index_handler(name, opensearch, args):
+    module = load_module(
+        f"benchmark_{name}", os.path.join(ROOT_DIR, "data_workflow", "lambdas", name, "handler.py")
+    )
+    module.requests = opensearch.requests
+
+    if args.embedding_batch_size is not None:
+        module.embedding_batch_size = args.embedding_batch_size
+
+    if args.embedding_concurrency is not None:
+        module.embedding_concurrency = args.embedding_concurrency
+
+    # The scenarios that measure the embedding cache set their own store
+    module.embedding_cache_type = "none"
+
+    # Rejected _bulk items are retried without waiting, the backoff would dominate the measurement
+    module.bulk_retry_backoff = 0.0
+
+    return module
+
+def read_pages(file_path):
+    for file_name in sorted(os.listdir(file_path)):
+        with open(os.path.join(file_path, file_name), "r") as file:
+            yield file.read()
+
+def call_get_chunks(module, file_name, file_path):
+    # lambda_index_documents reads the page files of a Textract job, lambda_index_txt the text of one object
+    if module.__name__ == "benchmark_lambda_index_documents":
+        return list(module.get_chunks(file_name, f"documents/{file_name}", file_path))
+
+    return list(module.get_chunks(file_name, read_pages(file_path)))
+
+def bench_get_chunks(module, pages, page_chars, repeats, seed):
+    rng = random.Random(seed)
+    directory = tempfile.mkdtemp(prefix="benchmark-chunks-")
+
+    try:
+        for page in range(1, pages + 1):
+            with open(os.path.join(directory, f"output_{page}.txt"), "w") as file:
+                file.write(get_page(rng, page_chars))
+
+        latencies = []
+        start = time.perf_counter()
+
+        for _ in range(repeats):
+            call_start = time.perf_counter()
+            chunks = call_get_chunks(module, "synthetic.pdf", directory)
+            latencies.append(time.perf_counter() - call_start)
+
+        result = summarize(latencies, pages * repeats, time.perf_counter() - start, "pages/s")
+        result["chunks"] = len(chunks)
+
+        return result
+    finally:
+        shutil.rmtree(directory)
+
+def bench_index_documents(module, opensearch, chunks, repeats, seed):
+    rng = random.Random(seed)
+    documents = [
+        {"file_name": "synthetic.pdf", "page": str(i // 4 + 1), "passage": get_page(rng, 700)}
+        for i in range(chunks)
+    ]
+    url = f"{ES_URL}/{ES_INDEX_NAME}-index-documents"
+
+    latencies = []
+    start = time.perf_counter()
+
+    for _ in range(repeats):
+        opensearch.indices.pop(f"{ES_INDEX_NAME}-index-documents", None)
+        module.create_index(url)
+
+        call_start = time.perf_counter()
+        module.index_documents(url, documents)
+        latencies.append(time.perf_counter() - call_start)
+
+    return summarize(latencies, chunks * repeats, time.perf_counter() - start, "chunks/s")
+
+def bench_embedding_cache(module, opensearch, store, chunks, repeats, seed):
+    # A duplicate of an indexed file uploaded to another index: every passage is an embedding cache hit
+    rng = random.Random(seed)
+    documents = [
+        {"file_name": "synthetic.pdf", "page": str(i // 4 + 1), "passage": get_page(rng, 700)}
+        for i in range(chunks)
+    ]
+    url = f"{ES_URL}/{ES_INDEX_NAME}-cached-documents"
+    module.embedding_store = store
+
+    try:
+        module.create_index(url)
+        module.index_documents(url, documents)
+
+        latencies = []
+        start = time.perf_counter()
+
+        for _ in range(repeats):
+            opensearch.indices.pop(f"{ES_INDEX_NAME}-cached-documents", None)
+            module.create_index(url)
+
+            call_start = time.perf_counter()
+            module.index_documents(url, documents)
+            latencies.append(time.perf_counter() - call_start)
+
+        return summarize(latencies, chunks * repeats, time.perf_counter() - start, "chunks/s")
+    finally:
+        opensearch.indices.pop(f"{ES_INDEX_NAME}-cached-documents", None)
+        module.embedding_store = None
+
+def bench_update_file_documents(module, opensearch, chunks, changed, repeats, seed):
+    # Re-upload of an indexed file where a share of the passages changed: only those are embedded, the version of the
+    # others is rewritten
+    rng = random.Random(seed)
+    documents = [
+        {"file_name": "synthetic.pdf", "page": str(i // 4 + 1), "passage": get_page(rng, 700)}
+        for i in range(chunks)
+    ]
+    url = f"{ES_URL}/{ES_INDEX_NAME}-update-documents"
+
+    opensearch.indices.pop(f"{ES_INDEX_NAME}-update-documents", None)
+    module.create_index(url)
+    module.update_file_documents(url, "synthetic.pdf", documents)
+
+    latencies = []
+    start = time.perf_counter()
+
+    for _ in range(repeats):
+        for i in rng.sample(range(chunks), int(chunks * changed)):
+            documents[i] = {**documents[i], "passage": get_page(rng, 700)}
+
+        call_start = time.perf_counter()
+        module.update_file_documents(url, "synthetic.pdf", documents)
+        latencies.append(time.perf_counter() - call_start)
+
+    result = summarize(latencies, chunks * repeats, time.perf_counter() - start, "chunks/s")
+    result["documents"] = len(opensearch.indices[f"{ES_INDEX_NAME}-update-documents"].documents)
+
+    return result
+
+def bench_bulk_load(module, opensearch, chunks, enabled, max_segments, repeats, seed, results):
+    # A new file written to its own index, live or in bulk-load mode, then the first query against the index
+    rng = random.Random(seed)
+    documents = [
+        {"file_name": "synthetic.pdf", "page": str(i // 4 + 1), "passage": get_page(rng, 700)}
+        for i in range(chunks)
+    ]
+    query = {"size": 3, "query": {"knn": {"embedding": {"vector": fakes.get_embedding(get_sentence(rng)), "k": 3}}}}
+    url = f"{ES_URL}/{ES_INDEX_NAME}-bulk-load"
+
+    module.bulk_load = enabled
+    # Every file size of the benchmark goes through the mode
+    module.bulk_load_min_documents = 1
+    module.bulk_load_max_segments = max_segments
+
+    try:
+        latencies = []
+        query_latencies = []
+        start = time.perf_counter()
+
+        for _ in range(repeats):
+            opensearch.indices.pop(f"{ES_INDEX_NAME}-bulk-load", None)
+            module.create_index(url)
+
+            call_start = time.perf_counter()
+            module.update_file_documents(url, "synthetic.pdf", documents)
+            latencies.append(time.perf_counter() - call_start)
+
+            call_start = time.perf_counter()
+            opensearch.search(f"{ES_INDEX_NAME}-bulk-load", query)
+            query_latencies.append(time.perf_counter() - call_start)
+
+        result = summarize(latencies, chunks * repeats, time.perf_counter() - start, "chunks/s")
+        result["segments"] = len(opensearch.indices[f"{ES_INDEX_NAME}-bulk-load"].segments)
+        results["first_query"] = summarize(query_latencies, repeats, sum(query_latencies), "queries/s")
+
+        return result
+    finally:
+        opensearch.indices.pop(f"{ES_INDEX_NAME}-bulk-load", None)
+        module.bulk_load = False
+
+def load_corpus(opensearch, index_name, documents, similarity, seed):
+    rng = random.Random(seed)
+    opensearch.create_index(index_name, {
+        "settings": {"index": {"knn": True}},
+        "mappings": {"properties": {
+            "embedding": {"type": "knn_vector", "dimension": fakes.EMBEDDING_DIMENSION, "similarity": similarity},
+            "file_name": {"type": "text"},
+            "page": {"type": "text"},
+            "passage": {"type": "text"}
+        }}
+    })
+
+    for i in range(documents):
+        passage = get_page(rng, 700)
+        opensearch.index_document(index_name, {
+            "embedding": fakes.get_embedding(passage),
+            "file_name": f"synthetic_{i // 50}.pdf",
+            "page": str(i % 50 + 1),
+            "passage": passage
+        }, str(i + 1))
+
+def bench_lambda_handler(handler, requests, selected_type, stream, warmup, seed):
+    rng = random.Random(seed)
+    latencies = []
+    start = None
+
+    # The first requests build the chain, they are run but not measured
+    for i in range(-warmup, requests):
+        if i == 0:
+            start = time.perf_counter()
+
+        event = {
+            "question": f"{get_sentence(rng, 10)} {i}",
+            "chat_memory": [] if i % 2 == 0 else [[get_sentence(rng), get_sentence(rng)]],
+            "selected_type": selected_type,
+            "llm_endpoint": "Falcon 40-B",
+            "embeddings_endpoint": "GPT-J",
+            "user": "",
+            "stream": stream
+        }
+
+        call_start = time.perf_counter()
+        response = handler.lambda_handler(event, None)
+
+        if i >= 0:
+            latencies.append(time.perf_counter() - call_start)
+
+        if response["statusCode"] != 200:
+            raise RuntimeError(f"lambda_handler failed: {response}")
+
+    return summarize(latencies, requests, time.perf_counter() - start, "req/s")
+
+def get_backend_config():
+    with open(os.path.join(ROOT_DIR, "backend", "configs.yaml"), "r") as file:
+        config = yaml.safe_load(file)
+
+    config["es_credentials"]["endpoint"] = ES_URL
+    config["es_credentials"]["index"] = f"{ES_INDEX_NAME}-backend"
+
+    return config
+
+def run(args):
+    runtime = fakes.FakeSagemakerRuntime(token_latency=args.token_latency, embedding_latency=args.embedding_latency,
+                                         max_payload_bytes=args.max_payload_bytes)
+    opensearch = fakes.InMemoryOpenSearch(search_latency=args.search_latency, request_latency=args.request_latency,
+                                          bulk_reject_rate=args.bulk_reject_rate, seed=args.seed,
+                                          refresh_latency=args.refresh_latency, replica_latency=args.replica_latency,
+                                          graph_load_latency=args.graph_load_latency, segment_latency=args.segment_latency)
+    s3 = fakes.FakeS3()
+    fakes.install(runtime, opensearch, s3)
+
+    config = get_backend_config()
+    s3.put_object(Bucket=BUCKET, Key=CONFIG_KEY, Body=yaml.safe_dump(config))
+
+    handler = load_module("benchmark_backend_handler", os.path.join(ROOT_DIR, "backend", "lambdas", "handler.py"))
+    index_handler = load_index_handler(args.index_handler, opensearch, args)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = {}
+
+    def record(name, function):
+        # The Lambdas print progress, keep the report readable
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            results[name] = function()
+
+        print(f"{name:<45} {results[name]['throughput']:>10.2f} {results[name]['unit']:<9} "
+              f"p50={results[name]['p50_ms']:9.3f} ms  p95={results[name]['p95_ms']:9.3f} ms  p99={results[name]['p99_ms']:9.3f} ms")
+
+    for pages in args.pages:
+        record(f"get_chunks[pages={pages}]",
+               lambda: bench_get_chunks(index_handler, pages, args.page_chars, args.repeats, args.seed))
+
+    for chunks in args.chunks:
+        record(f"index_documents[chunks={chunks}]",
+               lambda: bench_index_documents(index_handler, opensearch, chunks, args.repeats, args.seed))
+
+    cache_directory = tempfile.mkdtemp(prefix="benchmark-embedding-cache-")
+    stores = {
+        "sqlite": lambda: index_handler.SQLiteEmbeddingStore("benchmark-embeddings", "1",
+                                                             os.path.join(cache_directory, "embeddings.db"), 100000),
+        "s3": lambda: index_handler.S3EmbeddingStore("benchmark-embeddings", "1", BUCKET, "embedding-cache")
+    }
+
+    try:
+        for chunks in args.chunks:
+            for store_type, get_store in stores.items():
+                record(f"index_documents[chunks={chunks},cache={store_type}]",
+                       lambda: bench_embedding_cache(index_handler, opensearch, get_store(), chunks, args.repeats, args.seed))
+    finally:
+        shutil.rmtree(cache_directory)
+
+    for chunks in args.chunks:
+        for changed in args.changed:
+            record(f"update_file_documents[chunks={chunks},changed={changed:.0%}]",
+                   lambda: bench_update_file_documents(index_handler, opensearch, chunks, changed, args.repeats, args.seed))
+
+    for chunks in args.chunks:
+        for mode in ["off", "on"]:
+            load_results = {}
+            record(f"update_file_documents[chunks={chunks},bulk_load={mode}]",
+                   lambda: bench_bulk_load(index_handler, opensearch, chunks, mode == "on", args.bulk_load_max_segments,
+                                           args.repeats, args.seed, load_results))
+            record(f"first_query[chunks={chunks},bulk_load={mode}]", lambda: load_results["first_query"])
+
+    index_name = config["es_credentials"]["index"]
+
+    for documents in args.corpus:
+        opensearch.indices.pop(index_name, None)
+        load_corpus(opensearch, index_name, documents, "l2_norm", args.seed)
+        handler.answer_cache.clear()
+
+        for stream in [False, True]:
+            mode = "stream" if stream else "sync"
+            record(f"lambda_handler[{mode},corpus={documents}]",
+                   lambda: bench_lambda_handler(handler, args.requests, args.selected_type, stream, args.warmup,
+                                                args.seed + documents + int(stream)))
+
+    return results
+
+def compare(results, baseline, tolerance):
+    regressions = []
+
+    for name, result in results.items():
+        if name not in baseline:
+            regressions.append(f"{name}: missing from the baseline, run with --update-baseline")
+            continue
+
+        reference = baseline[name]
+
+        if result["p95_ms"] > reference["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {reference['p95_ms']} ms -> {result['p95_ms']} ms")
+        if result["throughput"] < reference["throughput"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {reference['throughput']} -> {result['throughput']} {result['unit']}")
+
+    return regressions
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the backend and indexing Lambdas")
+    parser.add_argument("--pages", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--page-chars", type=int, default=3000)
+    parser.add_argument("--chunks", type=int, nargs="+", default=[100, 500])
+    parser.add_argument("--changed", type=float, nargs="+", default=[0.05],
+                        help="Share of the passages changed between two uploads of a file")
+    parser.add_argument("--corpus", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--warmup", type=int, default=2, help="Unmeasured lambda_handler requests per scenario")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--selected-type", default="Chatbot")
+    parser.add_argument("--index-handler", default="lambda_index_documents",
+                        choices=["lambda_index_documents", "lambda_index_txt"])
+    parser.add_argument("--token-latency", type=float, default=0.0, help="Seconds per generated token")
+    parser.add_argument("--embedding-latency", type=float, default=0.0, help="Seconds per embedding call")
+    parser.add_argument("--search-latency", type=float, default=0.0, help="Seconds per OpenSearch search")
+    parser.add_argument("--request-latency", type=float, default=0.0, help="Seconds per OpenSearch HTTP request")
+    parser.add_argument("--bulk-reject-rate", type=float, default=0.0, help="Share of _bulk items rejected with 429")
+    parser.add_argument("--refresh-latency", type=float, default=0.0, help="Seconds per OpenSearch refresh or merged segment")
+    parser.add_argument("--replica-latency", type=float, default=0.0,
+                        help="Seconds per _bulk request and replica, and per segment copied to an added replica")
+    parser.add_argument("--graph-load-latency", type=float, default=0.0, help="Seconds to load the k-NN graph of a segment")
+    parser.add_argument("--segment-latency", type=float, default=0.0, help="Seconds per segment searched")
+    parser.add_argument("--bulk-load-max-segments", type=int, default=1, help="Force-merge target of the bulk-load mode")
+    parser.add_argument("--max-payload-bytes", type=int, default=None, help="Embedding requests above are rejected")
+    parser.add_argument("--embedding-batch-size", type=int, default=None, help="Overrides EMBEDDING_BATCH_SIZE")
+    parser.add_argument("--embedding-concurrency", type=int, default=None, help="Overrides EMBEDDING_CONCURRENCY")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--output", default=None, help="Also write the results to this JSON file")
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = get_args()
+    results = run(args)
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(results, file, indent=2)
+
+        print(f"Baseline written to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, "r") as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+
+        if regressions:
+            print("Regressions against the baseline:")
+
+            for regression in regressions:
+                print(f"  {regression}")
+
+            sys.exit(1)
+
+        print("No regression against the baseline")
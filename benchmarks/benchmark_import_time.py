@@ -0,0 +1,175 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Import-time (cold start) profile of the Lambda entry points.
+#
+#   python benchmarks/benchmark_import_time.py                       report and compare with import_time_baseline.json
+#   python benchmarks/benchmark_import_time.py --update-baseline     report and store the results as the new baseline
+#
+# Every scenario runs in a fresh interpreter with -X importtime: the module import and one lambda_handler call for a
+# path that needs no AWS service are timed. The exit code is 1 when a scenario got slower than the baseline by more
+# than --tolerance, or when a path loads a module it must not need.
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.join(BENCHMARKS_DIR, "..")
+BASELINE_PATH = os.path.join(BENCHMARKS_DIR, "import_time_baseline.json")
+
+SCENARIOS = {
+    "backend[invalidate_configs]": {
+        "path": os.path.join("backend", "lambdas"),
+        "event": {"action": "invalidate_configs"},
+        "forbidden": ["opensearchpy", "tiktoken"]
+    },
+    "lambda_index_txt[no records]": {
+        "path": os.path.join("data_workflow", "lambdas", "lambda_index_txt"),
+        "event": {},
+        "forbidden": ["langchain", "tiktoken", "tqdm"]
+    },
+    "lambda_index_documents[failed job]": {
+        "path": os.path.join("data_workflow", "lambdas", "lambda_index_documents"),
+        "event": {"statusCode": 500},
+        "forbidden": ["langchain", "trp", "textractcaller", "tqdm"]
+    }
+}
+
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import handler
+import_ms = (time.perf_counter() - start) * 1000
+modules_after_import = set(sys.modules)
+start = time.perf_counter()
+handler.lambda_handler(json.loads(sys.argv[1]), None)
+call_ms = (time.perf_counter() - start) * 1000
+print(json.dumps({"import_ms": import_ms, "call_ms": call_ms, "modules": sorted(sys.modules),
+                  "lazy_modules": sorted(set(sys.modules) - modules_after_import)}))
+"""
+
+def parse_importtime(stderr):
+    # "import time: self [us] | cumulative | imported package", nesting is given by the indentation of the name
+    imports = []
+
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((depth, name.strip(), int(cumulative) / 1000))
+
+    return imports
+
+def get_direct_imports(imports, module="handler"):
+    # -X importtime prints children before their parent, the direct imports of a module sit at depth 1 just above it
+    for i, (depth, name, _) in enumerate(imports):
+        if depth == 0 and name == module:
+            direct = []
+
+            for child_depth, child_name, child_ms in reversed(imports[:i]):
+                if child_depth == 0:
+                    break
+                if child_depth == 1:
+                    direct.append((child_name, child_ms))
+
+            return sorted(direct, key=lambda item: -item[1])
+
+    return []
+
+def run_scenario(scenario, runs):
+    env = {**os.environ, "AWS_DEFAULT_REGION": os.environ.get("AWS_DEFAULT_REGION", "eu-west-1"), "METRICS_SINK": "none"}
+    results = []
+
+    for _ in range(runs):
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", CHILD, json.dumps(scenario["event"])],
+            cwd=os.path.join(ROOT_DIR, scenario["path"]), env=env, capture_output=True, text=True
+        )
+
+        if process.returncode != 0:
+            raise RuntimeError(process.stderr[-2000:])
+
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+        result["imports"] = parse_importtime(process.stderr)
+        results.append(result)
+
+    return {
+        "import_ms": round(statistics.median(result["import_ms"] for result in results), 1),
+        "call_ms": round(statistics.median(result["call_ms"] for result in results), 1),
+        "modules": len(results[-1]["modules"]),
+        "loaded": [
+            module for module in scenario["forbidden"]
+            if any(name == module or name.startswith(module + ".") for name in results[-1]["modules"])
+        ],
+        "lazy_modules": len(results[-1]["lazy_modules"]),
+        "direct_imports": get_direct_imports(results[-1]["imports"])
+    }
+
+def report(name, result, top):
+    print(f"{name}")
+    print(f"  import {result['import_ms']:8.1f} ms  first call {result['call_ms']:8.1f} ms  "
+          f"{result['modules']} modules loaded, {result['lazy_modules']} of them during the call")
+
+    for module, milliseconds in result["direct_imports"][:top]:
+        print(f"    {milliseconds:8.1f} ms  {module}")
+
+def compare(results, baseline, tolerance):
+    regressions = []
+
+    for name, result in results.items():
+        if result["loaded"]:
+            regressions.append(f"{name}: loads {', '.join(result['loaded'])}")
+
+        if name in baseline:
+            total = result["import_ms"] + result["call_ms"]
+            reference = baseline[name]["import_ms"] + baseline[name]["call_ms"]
+
+            if total > reference * (1 + tolerance):
+                regressions.append(f"{name}: {reference:.1f} ms -> {total:.1f} ms")
+
+    return regressions
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Import-time profile of the Lambda entry points")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10, help="Direct imports listed per entry point")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--tolerance", type=float, default=0.3)
+    parser.add_argument("--update-baseline", action="store_true")
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = get_args()
+    results = {}
+
+    for name, scenario in SCENARIOS.items():
+        results[name] = run_scenario(scenario, args.runs)
+        report(name, results[name], args.top)
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump({name: {"import_ms": result["import_ms"], "call_ms": result["call_ms"]}
+                       for name, result in results.items()}, file, indent=2)
+
+        print(f"Baseline written to {args.baseline}")
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)
+
+    regressions = compare(results, baseline, args.tolerance)
+
+    if regressions:
+        print("Regressions:")
+
+        for regression in regressions:
+            print(f"  {regression}")
+
+        sys.exit(1)
+
+    print("No import-time regression")
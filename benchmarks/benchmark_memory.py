@@ -0,0 +1,184 @@
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmark_e2e import ES_INDEX_NAME, ES_URL, get_page, load_index_handler
+import fakes
+
+# Peak memory of the txt ingestion path on large synthetic files, traced with tracemalloc.
+#
+#   python benchmarks/benchmark_memory.py                         chunking and ingestion of 8 and 256 MB files, 40 minutes
+#   python benchmarks/benchmark_memory.py --ci                    chunking and ingestion of 2 and 16 MB files, 2 minutes
+#
+# The objects are served from disk by the fake S3 and the fake OpenSearch drops what it is sent, so the peak is the
+# memory held by the Lambda. The exit code is 1 when a peak exceeds --max-peak-mb or grows with the file size by
+# more than --tolerance. tracemalloc slows allocations down several times, the throughput is not comparable with
+# benchmark_e2e.py. The fake embeddings have --embedding-dimension values: the pipeline holds a fixed number of
+# batches, the 4096 values of GPT-J raise the peak by a constant and the run time by two orders of magnitude.
+
+BUCKET = "benchmark-bucket"
+
+def write_file(path, size_mb, seed):
+    # About 1 MB of paragraphs, written again until the size is reached. Every sentence is numbered with the
+    # repetition, so that the passages of the file are all distinct as in a real document
+    rng = random.Random(seed)
+    paragraphs = [get_page(rng, 3000) for _ in range(350)]
+    repetition = 0
+
+    with open(path, "w") as file:
+        while file.tell() < size_mb * 1024 * 1024:
+            for paragraph in paragraphs:
+                file.write(paragraph.replace(". ", f" {repetition}. ") + "\n\n")
+
+            repetition += 1
+
+def trace(function):
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    try:
+        result = function()
+    finally:
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {**result, "seconds": round(elapsed, 2), "peak_mb": round(peak / 1024 / 1024, 2)}
+
+def bench_get_chunks(module, key):
+    chunks = 0
+
+    for _ in module.get_chunks(key, module.read_txt_file(BUCKET, key)):
+        chunks += 1
+
+    return {"chunks": chunks}
+
+def bench_lambda_handler(module, key):
+    module.lambda_handler({"Records": [{
+        "eventName": "ObjectCreated:Put",
+        "s3": {"bucket": {"name": BUCKET}, "object": {"key": key}}
+    }]}, None)
+
+    return {}
+
+def run(args):
+    runtime = fakes.FakeSagemakerRuntime(embedding_dimension=args.embedding_dimension)
+    opensearch = fakes.InMemoryOpenSearch(store_documents=False)
+    s3 = fakes.FakeS3()
+    fakes.install(runtime, opensearch, s3)
+
+    module = load_index_handler("lambda_index_txt", opensearch, args)
+    module.es_url = ES_URL
+    module.es_index_name = f"{ES_INDEX_NAME}-memory"
+    logging.getLogger().setLevel(logging.WARNING)
+
+    # Lazy imports and clients are loaded before tracing
+    s3.put_object(Bucket=BUCKET, Key="warmup.txt", Body=get_page(random.Random(args.seed), 3000))
+
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        bench_lambda_handler(module, "warmup.txt")
+
+    scenarios = [("get_chunks", size, bench_get_chunks) for size in args.sizes]
+    scenarios += [("lambda_handler", size, bench_lambda_handler) for size in args.ingest_sizes]
+    results = {}
+    directory = tempfile.mkdtemp(prefix="benchmark-memory-")
+
+    try:
+        for name, size, function in scenarios:
+            path = os.path.join(directory, f"synthetic_{size}.txt")
+
+            if not os.path.exists(path):
+                write_file(path, size, args.seed)
+                s3.put_file(Bucket=BUCKET, Key=f"{size}mb.txt", path=path)
+
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                result = trace(lambda: function(module, f"{size}mb.txt"))
+
+            result["mb_per_s"] = round(size / result["seconds"], 2)
+            results[f"{name}[{size}MB]"] = result
+
+            print(f"{name}[{size}MB]".ljust(30) + f"peak {result['peak_mb']:8.2f} MB  {result['mb_per_s']:8.2f} MB/s"
+                  + (f"  {result['chunks']} chunks" if "chunks" in result else ""))
+    finally:
+        for file_name in os.listdir(directory):
+            os.remove(os.path.join(directory, file_name))
+
+        os.rmdir(directory)
+
+    return results
+
+def check(results, max_peak_mb, tolerance):
+    failures = []
+
+    for name, result in results.items():
+        if result["peak_mb"] > max_peak_mb:
+            failures.append(f"{name}: peak {result['peak_mb']} MB above {max_peak_mb} MB")
+
+    # The smallest file of a scenario is the reference, a bounded pipeline keeps the same peak on the largest
+    for scenario in ["get_chunks", "lambda_handler"]:
+        peaks = [(float(name[len(scenario) + 1:-3]), result["peak_mb"])
+                 for name, result in results.items() if name.startswith(scenario + "[")]
+
+        if len(peaks) > 1:
+            peaks.sort()
+
+            if peaks[-1][1] > peaks[0][1] * (1 + tolerance):
+                failures.append(f"{scenario}: peak grows from {peaks[0][1]} MB ({peaks[0][0]:g} MB file) "
+                                f"to {peaks[-1][1]} MB ({peaks[-1][0]:g} MB file)")
+
+    return failures
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Peak memory of the txt ingestion path")
+    parser.add_argument("--sizes", type=float, nargs="*", default=None,
+                        help="File sizes in MB, chunking only (default 8 256, 2 16 with --ci)")
+    parser.add_argument("--ingest-sizes", type=float, nargs="*", default=None,
+                        help="File sizes in MB, whole lambda_handler with embedding and indexing (default as --sizes)")
+    parser.add_argument("--embedding-dimension", type=int, default=16)
+    parser.add_argument("--max-peak-mb", type=float, default=128)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--ci", action="store_true", help="Smaller file sizes, the peak is still checked for growth")
+    parser.add_argument("--output", default=None, help="Also write the results to this JSON file")
+
+    args = parser.parse_args()
+
+    if args.sizes is None:
+        args.sizes = [2, 16] if args.ci else [8, 256]
+
+    if args.ingest_sizes is None:
+        args.ingest_sizes = [2, 16] if args.ci else [8, 256]
+
+    # Read by load_index_handler
+    args.embedding_batch_size = None
+    args.embedding_concurrency = None
+
+    return args
+
+if __name__ == "__main__":
+    args = get_args()
+    results = run(args)
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    failures = check(results, args.max_peak_mb, args.tolerance)
+
+    if failures:
+        print("Failures:")
+
+        for failure in failures:
+            print(f"  {failure}")
+
+        sys.exit(1)
+
+    print("Peak memory bounded")
@@ -0,0 +1,713 @@
+import hashlib
+import inspect
+import io
+import json
+import os
+import random
+import re
+import threading
+import time
+from urllib.parse import urlparse
+
+import boto3
+from botocore.exceptions import ClientError
+import numpy as np
+import requests
+
+EMBEDDING_DIMENSION = 4096
+
+# In-process stand-ins for SageMaker, OpenSearch and S3, so that the Lambdas can be measured without AWS
+
+def get_tokens(text):
+    return re.findall(r"\w+", text.lower())
+
+def get_embedding(text, dimension=EMBEDDING_DIMENSION):
+    # Deterministic feature hashing: texts sharing words get close vectors, so kNN results are meaningful
+    vector = np.zeros(dimension, dtype=np.float32)
+
+    for token in get_tokens(text):
+        digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+        value = int.from_bytes(digest, "little")
+        vector[value % dimension] += 1.0 if (value >> 63) else -1.0
+
+    norm = np.linalg.norm(vector)
+
+    if norm == 0:
+        vector[0] = 1.0
+        norm = 1.0
+
+    return (vector / norm).tolist()
+
+class FakeStreamingBody(io.BytesIO):
+    def iter_chunks(self, chunk_size=1024):
+        for data in iter(lambda: self.read(chunk_size), b""):
+            yield data
+
+class FakeFileStreamingBody(io.FileIO):
+    # Objects stored as files on disk, their size does not count in the memory of the process
+    def iter_chunks(self, chunk_size=1024):
+        for data in iter(lambda: self.read(chunk_size), b""):
+            yield data
+
+class FakeSagemakerRuntime:
+    # GPT-J style embeddings for {"text_inputs": ...} bodies, Falcon (TGI) generations for {"inputs": ...} bodies
+    def __init__(self, token_latency=0.0, embedding_latency=0.0, answer_tokens=32, max_payload_bytes=None,
+                 embedding_dimension=EMBEDDING_DIMENSION):
+        self.token_latency = token_latency
+        self.embedding_latency = embedding_latency
+        self.embedding_dimension = embedding_dimension
+        self.max_payload_bytes = max_payload_bytes
+        self.answer_tokens = answer_tokens
+        self.embedding_calls = 0
+        self.generation_calls = 0
+        self.lock = threading.Lock()
+
+    def get_answer_tokens(self, prompt):
+        words = get_tokens(prompt)[-self.answer_tokens:] or ["answer"]
+
+        return [words[i % len(words)] for i in range(self.answer_tokens)]
+
+    def invoke_endpoint(self, EndpointName, Body, ContentType=None, Accept=None, **kwargs):
+        if self.max_payload_bytes is not None and len(Body) > self.max_payload_bytes:
+            raise ClientError({"Error": {"Code": "ValidationError", "Message": "Request payload too large"}}, "InvokeEndpoint")
+
+        body = json.loads(Body)
+
+        if "text_inputs" in body:
+            with self.lock:
+                self.embedding_calls += 1
+
+            texts = body["text_inputs"] if isinstance(body["text_inputs"], list) else [body["text_inputs"]]
+            time.sleep(self.embedding_latency)
+
+            embeddings = [get_embedding(text, self.embedding_dimension) for text in texts]
+
+            return {"Body": FakeStreamingBody(json.dumps({"embedding": embeddings}).encode("utf-8"))}
+
+        with self.lock:
+            self.generation_calls += 1
+
+        tokens = self.get_answer_tokens(body["inputs"])
+        time.sleep(self.token_latency * len(tokens))
+        generated_text = body["inputs"] + " " + " ".join(tokens) + "\nHuman:"
+
+        return {"Body": FakeStreamingBody(json.dumps([{"generated_text": generated_text}]).encode("utf-8"))}
+
+    def invoke_endpoint_with_response_stream(self, EndpointName, Body, ContentType=None, Accept=None, **kwargs):
+        body = json.loads(Body)
+
+        with self.lock:
+            self.generation_calls += 1
+
+        def events():
+            for token in self.get_answer_tokens(body["inputs"]):
+                time.sleep(self.token_latency)
+                yield {"PayloadPart": {"Bytes": f'data:{json.dumps({"token": {"text": " " + token}})}\n'.encode("utf-8")}}
+
+        return {"Body": events()}
+
+class FakeS3:
+    def __init__(self):
+        self.objects = {}
+        self.files = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        if isinstance(Body, str):
+            Body = Body.encode("utf-8")
+
+        self.objects[(Bucket, Key)] = (Body, '"{}"'.format(hashlib.md5(Body).hexdigest()))
+
+    def put_file(self, Bucket, Key, path):
+        self.files[(Bucket, Key)] = path
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, **kwargs):
+        if (Bucket, Key) in self.files:
+            path = self.files[(Bucket, Key)]
+
+            return {"Body": FakeFileStreamingBody(path), "ContentLength": os.path.getsize(path)}
+
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey", "Message": Key}}, "GetObject")
+
+        body, etag = self.objects[(Bucket, Key)]
+
+        if IfNoneMatch is not None and IfNoneMatch == etag:
+            raise ClientError({"Error": {"Code": "304", "Message": "Not Modified"}}, "GetObject")
+
+        return {"Body": FakeStreamingBody(body), "ETag": etag, "ContentLength": len(body)}
+
+class FakeResponse:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.body = body
+        self.text = json.dumps(body)
+
+    def json(self):
+        return self.body
+
+class FakeIndex:
+    def __init__(self, settings, mappings):
+        # Index settings, flat: {"index": {"knn": true}} and {"knn": true} are the same
+        self.settings = dict(settings.get("index", settings))
+        self.mappings = mappings
+        self.documents = {}
+        # Segments as [documents, k-NN graph loaded]: a refresh writes the buffered documents as a new segment
+        self.segments = []
+        self.buffered = 0
+        self.next_id = 1
+        self.matrix = None
+        self.matrix_ids = None
+
+    def get_similarity(self, field):
+        properties = self.mappings.get("properties", {}).get(field, {})
+
+        if properties.get("method", {}).get("space_type") == "cosinesimil":
+            return "cosine"
+
+        return properties.get("similarity", "l2_norm")
+
+    def put(self, document_id, source):
+        if document_id is None:
+            document_id = str(self.next_id)
+            self.next_id += 1
+
+        created = document_id not in self.documents
+        self.documents[document_id] = source
+        self.matrix = None
+
+        return document_id, created
+
+    def get_setting(self, name, default):
+        value = self.settings.get(name)
+
+        return default if value is None else value
+
+    def get_matrix(self, field):
+        # Rebuilt lazily after writes, searches run against one float32 matrix
+        if self.matrix is None:
+            self.matrix_ids = [document_id for document_id, source in self.documents.items() if field in source]
+            self.matrix = np.array([self.documents[document_id][field] for document_id in self.matrix_ids], dtype=np.float32)
+
+        return self.matrix_ids, self.matrix
+
+class FakeIndicesClient:
+    def __init__(self, opensearch):
+        self.opensearch = opensearch
+
+    def get_mapping(self, index):
+        return {index: {"mappings": self.opensearch.get_index(index).mappings}}
+
+    def exists(self, index):
+        return index in self.opensearch.indices
+
+class InMemoryOpenSearch:
+    # Serves both the HTTP calls of the indexing Lambdas (see requests) and the opensearch-py calls of the backend
+    def __init__(self, search_latency=0.0, request_latency=0.0, bulk_reject_rate=0.0, seed=0, store_documents=True,
+                 refresh_latency=0.0, replica_latency=0.0, graph_load_latency=0.0, segment_latency=0.0):
+        self.indices = {}
+        # Off for the memory benchmark, writes are acknowledged and dropped
+        self.store_documents = store_documents
+        self.search_latency = search_latency
+        # Round trip of every HTTP call, the opensearch-py interface pays search_latency only
+        self.request_latency = request_latency
+        # Share of _bulk items answered with 429, as a cluster under write pressure does
+        self.bulk_reject_rate = bulk_reject_rate
+        # Segment cost model, all off by default. A refresh writes one segment and builds its graph (refresh_latency),
+        # after every _bulk request unless refresh_interval is -1. Each replica indexes every _bulk request again, and
+        # copies every segment when replicas are added (replica_latency). A search loads the graphs of the segments
+        # it has not seen yet (graph_load_latency each) and searches every segment (segment_latency each)
+        self.refresh_latency = refresh_latency
+        self.replica_latency = replica_latency
+        self.graph_load_latency = graph_load_latency
+        self.segment_latency = segment_latency
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.requests = FakeRequests(self)
+        self.indices_client = FakeIndicesClient(self)
+        self.routes = [
+            ("HEAD", r"^/(?P<index>[^/_][^/]*)$", self.head_index),
+            ("PUT", r"^/(?P<index>[^/_][^/]*)$", self.create_index),
+            ("DELETE", r"^/(?P<index>[^/_][^/]*)$", self.delete_index),
+            ("POST", r"^/(?P<index>[^/_][^/]*)/_doc/(?P<document_id>[^/]+)$", self.index_document),
+            ("PUT", r"^/(?P<index>[^/_][^/]*)/_doc/(?P<document_id>[^/]+)$", self.index_document),
+            ("POST", r"^/(?P<index>[^/_][^/]*)/_doc$", self.index_document),
+            ("POST", r"^/(?P<index>[^/_][^/]*)/_bulk$", self.bulk),
+            ("POST", r"^/_bulk$", self.bulk),
+            ("PUT", r"^/(?P<index>[^/_][^/]*)/_mapping$", self.put_mapping),
+            ("GET", r"^/(?P<index>[^/_][^/]*)/_mapping$", self.get_mapping),
+            ("GET", r"^/(?P<index>[^/_][^/]*)/_search$", self.search_route),
+            ("POST", r"^/(?P<index>[^/_][^/]*)/_search$", self.search_route),
+            ("GET", r"^/(?P<index>[^/_][^/]*)/_count$", self.count),
+            ("POST", r"^/(?P<index>[^/_][^/]*)/_delete_by_query$", self.delete_by_query),
+            ("POST", r"^/(?P<index>[^/_][^/]*)/_update_by_query$", self.update_by_query),
+            ("POST", r"^/(?P<index>[^/_][^/]*)/_mget$", self.mget),
+            ("GET", r"^/(?P<index>[^/_][^/]*)/_settings$", self.get_settings),
+            ("PUT", r"^/(?P<index>[^/_][^/]*)/_settings$", self.put_settings),
+            ("POST", r"^/(?P<index>[^/_][^/]*)/_refresh$", self.refresh_route),
+            ("POST", r"^/(?P<index>[^/_][^/]*)/_forcemerge$", self.force_merge),
+            ("GET", r"^/_plugins/_knn/warmup/(?P<index>[^/_][^/]*)$", self.warmup),
+        ]
+
+    # opensearch-py client interface
+
+    def get_index(self, index):
+        if index not in self.indices:
+            raise ValueError(f"no such index [{index}]")
+
+        return self.indices[index]
+
+    def get(self, index, id, **kwargs):
+        with self.lock:
+            source = self.get_index(index).documents.get(id)
+
+        if source is None:
+            raise ValueError(f"document [{id}] not found in [{index}]")
+
+        return {"_index": index, "_id": id, "found": True, "_source": source}
+
+    def search(self, index, body, **kwargs):
+        time.sleep(self.search_latency)
+
+        with self.lock:
+            self.search_segments(self.get_index(index))
+
+            return self.run_search(self.get_index(index), body)
+
+    def msearch(self, body, **kwargs):
+        time.sleep(self.search_latency)
+        responses = []
+
+        with self.lock:
+            for header, query in zip(body[0::2], body[1::2]):
+                try:
+                    self.search_segments(self.get_index(header["index"]))
+                    responses.append(self.run_search(self.get_index(header["index"]), query))
+                except ValueError as e:
+                    responses.append({"error": str(e)})
+
+        return {"responses": responses}
+
+    # HTTP interface
+
+    def handle(self, method, url, json_body=None, data=None, params=None):
+        path = urlparse(url).path.rstrip("/")
+        time.sleep(self.request_latency)
+
+        if json_body is not None:
+            # requests serializes json= bodies, the server parses them again
+            json_body = json.loads(json.dumps(json_body))
+
+        for route_method, pattern, function in self.routes:
+            match = re.match(pattern, path)
+
+            if route_method == method and match:
+                body = json_body if json_body is not None else (data if data is not None else None)
+                kwargs = match.groupdict()
+
+                # Query string parameters, for the routes that read them
+                if "params" in inspect.signature(function).parameters:
+                    kwargs["params"] = params or {}
+
+                with self.lock:
+                    return function(body=body, **kwargs)
+
+        return FakeResponse(400, {"error": f"no handler found for {method} {path}"})
+
+    def head_index(self, index, body=None):
+        return FakeResponse(200 if index in self.indices else 404, {})
+
+    def create_index(self, index, body=None):
+        if index in self.indices:
+            return FakeResponse(400, {"error": {"type": "resource_already_exists_exception", "index": index}})
+
+        body = body or {}
+        self.indices[index] = FakeIndex(body.get("settings", {}), body.get("mappings", {}))
+
+        return FakeResponse(200, {"acknowledged": True, "index": index})
+
+    def delete_index(self, index, body=None):
+        if self.indices.pop(index, None) is None:
+            return FakeResponse(404, {"error": {"type": "index_not_found_exception", "index": index}})
+
+        return FakeResponse(200, {"acknowledged": True})
+
+    def index_document(self, index, body=None, document_id=None):
+        if index not in self.indices:
+            # Dynamic index creation, as OpenSearch does on the first write
+            self.indices[index] = FakeIndex({}, {})
+
+        if not self.store_documents:
+            return FakeResponse(201, {"_index": index, "_id": document_id, "result": "created"})
+
+        document_id, created = self.indices[index].put(document_id, body)
+
+        return FakeResponse(201 if created else 200, {
+            "_index": index, "_id": document_id, "result": "created" if created else "updated"
+        })
+
+    def bulk(self, body=None, index=None, params=None):
+        if isinstance(body, bytes):
+            body = body.decode("utf-8")
+
+        lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+        items = []
+        errors = False
+        written = {}
+        i = 0
+
+        while i < len(lines):
+            action, metadata = next(iter(lines[i].items()))
+            target = metadata.get("_index", index)
+
+            if action == "delete":
+                removed = target in self.indices and self.indices[target].documents.pop(metadata.get("_id"), None) is not None
+                items.append({action: {"_index": target, "_id": metadata.get("_id"), "status": 200 if removed else 404}})
+                i += 1
+                continue
+
+            source = lines[i + 1]
+            i += 2
+
+            if target is None:
+                errors = True
+                items.append({action: {"status": 400, "error": {"type": "action_request_validation_exception"}}})
+                continue
+
+            if self.bulk_reject_rate and self.random.random() < self.bulk_reject_rate:
+                errors = True
+                items.append({action: {"_index": target, "_id": metadata.get("_id"), "status": 429,
+                                       "error": {"type": "es_rejected_execution_exception"}}})
+                continue
+
+            if action == "create" and target in self.indices and metadata.get("_id") in self.indices[target].documents:
+                errors = True
+                items.append({action: {"_index": target, "_id": metadata.get("_id"), "status": 409,
+                                       "error": {"type": "version_conflict_engine_exception"}}})
+                continue
+
+            if action == "update":
+                # Partial update: the fields of "doc" are merged into the stored source
+                documents = self.indices[target].documents if target in self.indices else {}
+
+                if self.store_documents and metadata.get("_id") not in documents:
+                    errors = True
+                    items.append({action: {"_index": target, "_id": metadata.get("_id"), "status": 404,
+                                           "error": {"type": "document_missing_exception"}}})
+                    continue
+
+                source = {**documents.get(metadata.get("_id"), {}), **source["doc"]}
+
+            response = self.index_document(target, source, metadata.get("_id"))
+            items.append({action: {**response.body, "status": response.status_code}})
+            written.setdefault(target, 0)
+            written[target] += 1
+
+        for target, documents in written.items():
+            fake_index = self.indices[target]
+            fake_index.buffered += documents
+            time.sleep(self.replica_latency * int(fake_index.get_setting("number_of_replicas", 1)))
+
+            if str(fake_index.get_setting("refresh_interval", "1s")) != "-1" or (params or {}).get("refresh") == "true":
+                self.refresh(fake_index)
+
+        return FakeResponse(200, {"took": 0, "errors": errors, "items": items})
+
+    def put_mapping(self, index, body=None):
+        mappings = self.get_index(index).mappings
+
+        for key, value in (body or {}).items():
+            if isinstance(value, dict):
+                mappings.setdefault(key, {}).update(value)
+            else:
+                mappings[key] = value
+
+        return FakeResponse(200, {"acknowledged": True})
+
+    def get_mapping(self, index, body=None):
+        return FakeResponse(200, {index: {"mappings": self.get_index(index).mappings}})
+
+    def search_route(self, index, body=None):
+        self.search_segments(self.get_index(index))
+
+        return FakeResponse(200, self.run_search(self.get_index(index), body or {"query": {"match_all": {}}}))
+
+    def count(self, index, body=None):
+        return FakeResponse(200, {"count": len(self.get_index(index).documents)})
+
+    def mget(self, index, body=None):
+        if index not in self.indices:
+            return FakeResponse(404, {"error": {"type": "index_not_found_exception", "index": index}})
+
+        documents = self.indices[index].documents
+
+        return FakeResponse(200, {"docs": [
+            {"_index": index, "_id": document_id, "found": document_id in documents} for document_id in body["ids"]
+        ]})
+
+    def update_by_query(self, index, body=None):
+        # Sources are stored as is, every field and sub-field is already searchable
+        return FakeResponse(200, {"updated": len(self.get_index(index).documents), "failures": []})
+
+    def delete_by_query(self, index, body=None, params=None):
+        if index not in self.indices:
+            return FakeResponse(404, {"error": {"type": "index_not_found_exception", "index": index}})
+
+        fake_index = self.indices[index]
+        deleted = [document_id for document_id, source in fake_index.documents.items()
+                   if self.matches(source, body["query"], document_id)]
+
+        for document_id in deleted:
+            del fake_index.documents[document_id]
+
+        fake_index.matrix = None
+
+        if (params or {}).get("refresh") == "true":
+            self.refresh(fake_index)
+
+        return FakeResponse(200, {"deleted": len(deleted), "failures": []})
+
+    def get_settings(self, index, body=None):
+        # number_of_replicas is always returned and every value is a string, as OpenSearch does
+        settings = {"number_of_shards": 1, "number_of_replicas": 1, **self.get_index(index).settings}
+        settings = {key: str(value).lower() if isinstance(value, bool) else str(value) for key, value in settings.items()}
+
+        return FakeResponse(200, {index: {"settings": {"index": settings}}})
+
+    def put_settings(self, index, body=None):
+        fake_index = self.get_index(index)
+        replicas = int(fake_index.get_setting("number_of_replicas", 1))
+
+        # A null value resets the setting to its default
+        for key, value in (body or {}).get("index", body or {}).items():
+            if value is None:
+                fake_index.settings.pop(key, None)
+            else:
+                fake_index.settings[key] = value
+
+        added = int(fake_index.get_setting("number_of_replicas", 1)) - replicas
+        # Added replicas recover by copying the segments of the primary
+        time.sleep(self.replica_latency * max(added, 0) * len(fake_index.segments))
+
+        return FakeResponse(200, {"acknowledged": True})
+
+    def refresh(self, fake_index):
+        if fake_index.buffered > 0:
+            time.sleep(self.refresh_latency)
+            fake_index.segments.append([fake_index.buffered, False])
+            fake_index.buffered = 0
+
+    def refresh_route(self, index, body=None):
+        self.refresh(self.get_index(index))
+
+        return FakeResponse(200, {"_shards": {"total": 1, "successful": 1, "failed": 0}})
+
+    def force_merge(self, index, body=None, params=None):
+        fake_index = self.get_index(index)
+        max_segments = max(int((params or {}).get("max_num_segments", 1)), 1)
+
+        if len(fake_index.segments) > max_segments:
+            # The documents are spread over max_segments new segments, whose graphs are built and not loaded yet
+            documents = sum(segment[0] for segment in fake_index.segments)
+            fake_index.segments = [[documents // max_segments + (i < documents % max_segments), False]
+                                   for i in range(max_segments)]
+            time.sleep(self.refresh_latency * max_segments)
+
+        return FakeResponse(200, {"_shards": {"total": 1, "successful": 1, "failed": 0}})
+
+    def warmup(self, index, body=None):
+        self.load_segments(self.get_index(index))
+
+        return FakeResponse(200, {"_shards": {"total": 1, "successful": 1, "failed": 0}})
+
+    def load_segments(self, fake_index):
+        unloaded = [segment for segment in fake_index.segments if not segment[1]]
+        time.sleep(self.graph_load_latency * len(unloaded))
+
+        for segment in unloaded:
+            segment[1] = True
+
+    def search_segments(self, fake_index):
+        self.load_segments(fake_index)
+        time.sleep(self.segment_latency * len(fake_index.segments))
+
+    # Query execution
+
+    def matches(self, source, query, document_id=None):
+        # The filters used by the Lambdas: term, terms, ids, bool filter/must/must_not and match_all.
+        # A keyword sub-field reads its parent text field
+        if "term" in query:
+            field, value = next(iter(query["term"].items()))
+            return source.get(field.removesuffix(".keyword")) == (value["value"] if isinstance(value, dict) else value)
+        if "terms" in query:
+            field, values = next(iter(query["terms"].items()))
+            return source.get(field.removesuffix(".keyword")) in values
+        if "ids" in query:
+            return document_id in query["ids"]["values"]
+        if "bool" in query:
+            clauses = []
+
+            for key in ["must", "filter"]:
+                value = query["bool"].get(key, [])
+                clauses.extend(value if isinstance(value, list) else [value])
+
+            must_not = query["bool"].get("must_not", [])
+            must_not = must_not if isinstance(must_not, list) else [must_not]
+
+            return (all(self.matches(source, clause, document_id) for clause in clauses)
+                    and not any(self.matches(source, clause, document_id) for clause in must_not))
+
+        return True
+
+    def run_search(self, fake_index, body):
+        size = body.get("size", 10)
+        query = body.get("query", {"match_all": {}})
+        query_filter = None
+
+        if "bool" in query:
+            query_filter = query["bool"].get("filter")
+            query = query["bool"].get("must", {"match_all": {}})
+
+        if "knn" in query:
+            field, parameters = next(iter(query["knn"].items()))
+            query_filter = parameters.get("filter", query_filter)
+            scored = self.knn(fake_index, field, parameters["vector"], parameters.get("k", size), query_filter)
+        elif "multi_match" in query:
+            scored = self.text_match(fake_index, query["multi_match"]["query"], query["multi_match"].get("fields", ["*"]))
+        else:
+            scored = [(document_id, 1.0) for document_id in fake_index.documents]
+
+        if query_filter is not None:
+            scored = [(document_id, score) for document_id, score in scored
+                      if self.matches(fake_index.documents[document_id], query_filter, document_id)]
+
+        excludes = body.get("_source", {}).get("excludes", []) if isinstance(body.get("_source"), dict) else []
+        hits = [
+            {
+                "_index": "",
+                "_id": document_id,
+                "_score": score,
+                "_source": {key: value for key, value in fake_index.documents[document_id].items() if key not in excludes}
+            }
+            for document_id, score in scored[:size]
+        ]
+
+        return {
+            "took": 0,
+            "hits": {"total": {"value": len(scored), "relation": "eq"}, "max_score": hits[0]["_score"] if hits else None, "hits": hits}
+        }
+
+    def knn(self, fake_index, field, vector, k, query_filter=None):
+        ids, matrix = fake_index.get_matrix(field)
+
+        if query_filter is not None:
+            # Efficient filtering: the k nearest neighbours among the matching documents
+            allowed = [i for i, document_id in enumerate(ids) if self.matches(fake_index.documents[document_id], query_filter, document_id)]
+            ids, matrix = [ids[i] for i in allowed], matrix[allowed]
+
+        if len(ids) == 0:
+            return []
+
+        query = np.asarray(vector, dtype=np.float32)
+
+        # Same score transforms as the OpenSearch k-NN plugin
+        if fake_index.get_similarity(field) == "cosine":
+            similarities = matrix @ query / (np.linalg.norm(matrix, axis=1) * np.linalg.norm(query) + 1e-12)
+            scores = 1 / (2 - similarities)
+        else:
+            scores = 1 / (1 + np.sum((matrix - query) ** 2, axis=1))
+
+        top = np.argsort(-scores)[:k]
+
+        return [(ids[i], float(scores[i])) for i in top]
+
+    def text_match(self, fake_index, text, fields):
+        # Term overlap stands in for BM25, enough to exercise the hybrid path
+        terms = set(get_tokens(text))
+        scored = []
+
+        for document_id, source in fake_index.documents.items():
+            values = [value for key, value in source.items() if isinstance(value, str) and (fields == ["*"] or key in fields)]
+            score = float(sum(1 for token in get_tokens(" ".join(values)) if token in terms))
+
+            if score > 0:
+                scored.append((document_id, score))
+
+        scored.sort(key=lambda item: -item[1])
+
+        return scored
+
+class FakeRequests:
+    # Module level requests functions, bound to one InMemoryOpenSearch
+    exceptions = requests.exceptions
+
+    def __init__(self, opensearch):
+        self.opensearch = opensearch
+
+    def request(self, method, url, json=None, data=None, params=None, **kwargs):
+        return self.opensearch.handle(method.upper(), url, json_body=json, data=data, params=params)
+
+    def head(self, url, **kwargs):
+        return self.request("HEAD", url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+    def Session(self):
+        return FakeSession(self)
+
+class FakeSession:
+    def __init__(self, fake_requests):
+        self.fake_requests = fake_requests
+        self.auth = None
+        self.headers = {}
+
+    def mount(self, prefix, adapter):
+        pass
+
+    def close(self):
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self.fake_requests, name)
+
+class FakeOpenSearchClient:
+    # What opensearchpy.OpenSearch(...) returns inside the backend
+    def __init__(self, opensearch):
+        self.opensearch = opensearch
+        self.indices = opensearch.indices_client
+
+    def get(self, index, id, **kwargs):
+        return self.opensearch.get(index, id, **kwargs)
+
+    def search(self, index, body, **kwargs):
+        return self.opensearch.search(index, body, **kwargs)
+
+    def msearch(self, body, **kwargs):
+        return self.opensearch.msearch(body, **kwargs)
+
+def install(runtime, opensearch, s3):
+    # Every boto3 client and OpenSearch client created after this call talks to the fakes
+    original_client = boto3.session.Session.client
+
+    def client(self, service_name, *args, **kwargs):
+        if service_name == "sagemaker-runtime":
+            return runtime
+        if service_name == "s3":
+            return s3
+
+        return original_client(self, service_name, *args, **kwargs)
+
+    # boto3.client goes through the default session, so patching the class covers both
+    boto3.session.Session.client = client
+
+    import opensearchpy
+    opensearchpy.OpenSearch = lambda *args, **kwargs: FakeOpenSearchClient(opensearch)
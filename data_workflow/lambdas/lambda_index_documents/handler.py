@@ -1,16 +1,22 @@
+import array
+import bisect
 import boto3
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import json
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 import logging
 import os
 from pathlib import Path
+import queue
 import re
 import requests
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
-from textractcaller.t_call import get_full_json, Textract_API
-from tqdm import tqdm
-from trp import Document
+import threading
+import time
 import traceback
+import uuid
 
 logger = logging.getLogger(__name__)
 if len(logging.getLogger().handlers) > 0:
@@ -18,21 +24,100 @@ if len(logging.getLogger().handlers) > 0:
 else:
     logging.basicConfig(level=logging.INFO)
 
-s3_client = boto3.client('s3')
-sagemaker_runtime_client = boto3.client('sagemaker-runtime')
-textract_client = boto3.client("textract")
+# boto3 clients load their service model on creation, they are created on first use by the paths that need them
+clients = {}
+
+# Keep-alive connections to OpenSearch, reused by every request of the container
+session = None
+
+# cl100k_base tokenizer of the chunking path, loaded on first use
+encoding = None
+
+# Embedding cache of the indexing path, opened on first use
+embedding_store = None
+# Endpoint seconds per passage last measured by the container, to value the cache hits of a fully cached file
+embedding_seconds_per_passage = None
 
 es_username = os.getenv("ES_USERNAME", default=None)
 es_password = os.getenv("ES_PASSWORD", default=None)
 es_url = os.getenv("ES_URL", default=None)
 es_index_name = os.getenv("ES_INDEX_NAME", default=None)
 sagemaker_endpoint = os.getenv("SAGEMAKER_ENDPOINT", default=None)
+# "index": one index per upload folder. "shared": one index for every tenant, documents carry a tenant keyword
+tenancy = os.getenv("TENANCY_MODE", default="index")
+# Passages per invoke_endpoint call, the batch is also capped in characters (about 4 per token)
+embedding_batch_size = int(os.getenv("EMBEDDING_BATCH_SIZE", default=16))
+embedding_batch_max_chars = int(os.getenv("EMBEDDING_BATCH_MAX_CHARS", default=24000))
+# Text is normalized and split by windows of about TEXT_WINDOW_CHARS cut at paragraph breaks, whatever the file size
+text_window_chars = int(os.getenv("TEXT_WINDOW_CHARS", default=256 * 1024))
+# Embedding requests in flight, and batches held between two stages of the indexing pipeline
+embedding_concurrency = int(os.getenv("EMBEDDING_CONCURRENCY", default=4))
+pipeline_queue_size = int(os.getenv("PIPELINE_QUEUE_SIZE", default=8))
+# Embeddings already computed, by endpoint, model version and passage hash: "sqlite" (local file), "s3" or "none"
+embedding_cache_type = os.getenv("EMBEDDING_CACHE_TYPE", default="sqlite")
+embedding_cache_path = os.getenv("EMBEDDING_CACHE_PATH", default="/tmp/embedding_cache.db")
+embedding_cache_max_entries = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", default=5000))
+embedding_cache_bucket = os.getenv("EMBEDDING_CACHE_BUCKET", default=None)
+embedding_cache_prefix = os.getenv("EMBEDDING_CACHE_PREFIX", default="embedding-cache")
+# Part of the cache key, to be changed when the endpoint is redeployed with another model
+embedding_model_version = os.getenv("EMBEDDING_MODEL_VERSION", default="1")
+# _bulk requests are flushed at BULK_MAX_DOCS documents or BULK_MAX_BYTES of NDJSON, a 4096-dim document is about 80 KB
+bulk_max_docs = int(os.getenv("BULK_MAX_DOCS", default=100))
+bulk_max_bytes = int(os.getenv("BULK_MAX_BYTES", default=5 * 1024 * 1024))
+bulk_max_retries = int(os.getenv("BULK_MAX_RETRIES", default=3))
+bulk_retry_backoff = float(os.getenv("BULK_RETRY_BACKOFF", default=0.5))
+# Bulk-load mode: once a file brings BULK_LOAD_MIN_DOCUMENTS new passages, refresh and replicas of its index are off
+# until it is written. The index is then force-merged to BULK_LOAD_MAX_SEGMENTS segments (0: no force-merge) and its
+# k-NN graphs are loaded by the warmup API. Settings left by a load older than BULK_LOAD_TIMEOUT seconds are restored
+bulk_load = os.getenv("BULK_LOAD_MODE", default="false").lower() == "true"
+bulk_load_min_documents = int(os.getenv("BULK_LOAD_MIN_DOCUMENTS", default=500))
+bulk_load_max_segments = int(os.getenv("BULK_LOAD_MAX_SEGMENTS", default=0))
+bulk_load_timeout = int(os.getenv("BULK_LOAD_TIMEOUT", default=900))
+default_tenant = "_default"
 
-CHUNK_SIZE = 768
+# Chunks are sized in cl100k_base tokens: 192 tokens are about the 768 characters of the former character splitter
+CHUNK_SIZE = 192
+CHUNK_OVERLAP = 48
+# A page or window of fewer than CHUNK_SIZE_MIN tokens, such as a page number, is not indexed
+CHUNK_SIZE_MIN = 20
+# A chunk ends after the strongest separator of its second half, or on a token boundary when there is none
+CHUNK_SEPARATORS = ["\n\n", "\n", ".", "!", "?", ",", " "]
+
+# One pass joins the words hyphenated at a line end, turns single line breaks into spaces and runs of them into one
+normalize_pattern = re.compile(r"(\w)-\n(\w)|(\n\n+)|\n")
 output_file_path = "/tmp/docs"
 
-def create_index(url):
+def get_client(service_name):
+    if service_name not in clients:
+        clients[service_name] = boto3.client(service_name)
+
+    return clients[service_name]
+
+def get_session():
+    global session
+
+    if session is None:
+        session = requests.Session()
+        session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+        session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+    return session
+
+def create_index(url, tenant=None):
     try:
+        if tenant is not None:
+            create_shared_index(url)
+
+            return
+
+        response = get_session().head(url, auth=HTTPBasicAuth(es_username, es_password))
+
+        if response.status_code != 404:
+            print('Index already exists')
+            update_file_name_mapping(url)
+
+            return
+
         print("Creating Index")
         mapping = {
             'settings': {
@@ -48,19 +133,29 @@ def create_index(url):
                         'similarity': 'cosine'
                     },
                     'file_name': {
-                        'type': 'text'
+                        'type': 'text',
+                        # Exact file name, the documents of one file are replaced or deleted with it
+                        'fields': {
+                            'keyword': {
+                                'type': 'keyword'
+                            }
+                        }
                     },
                     'page': {
                         'type': 'text'
                     },
                     'passage': {
                         'type': 'text'
+                    },
+                    # Upload that last wrote or kept the document, the documents of older uploads are stale
+                    'version': {
+                        'type': 'keyword'
                     }
                 }
             }
         }
 
-        response = requests.put(url, auth=HTTPBasicAuth(es_username, es_password), json=mapping)
+        response = get_session().put(url, auth=HTTPBasicAuth(es_username, es_password), json=mapping)
         print(f'Index created: {response.text}')
     except Exception as e:
         stacktrace = traceback.format_exc()
@@ -68,37 +163,371 @@ def create_index(url):
 
         raise e
 
-def delete_index(url):
+def create_shared_index(url):
     try:
-        response = requests.head(url, auth=HTTPBasicAuth(es_username, es_password))
+        response = get_session().head(url, auth=HTTPBasicAuth(es_username, es_password))
 
         if response.status_code != 404:
-            print('Index already exists! Deleting...')
-            response = requests.delete(url, auth=HTTPBasicAuth(es_username, es_password))
+            print('Shared index already exists')
+            update_file_name_mapping(url)
+
+            return
+
+        print("Creating shared Index")
+        mapping = {
+            'settings': {
+                'index': {
+                    'knn': True  # Enable k-NN search for this index
+                }
+            },
+            'mappings': {
+                # Every write and search names its tenant, all of a tenant's documents live on one shard
+                '_routing': {
+                    'required': True
+                },
+                'properties': {
+                    'embedding': {  # k-NN vector field
+                        'type': 'knn_vector',
+                        'dimension': 4096,  # Dimension of the vector
+                        # faiss supports the efficient filtering used by the backend for the tenant filter
+                        'method': {
+                            'name': 'hnsw',
+                            'engine': 'faiss',
+                            'space_type': 'l2'
+                        }
+                    },
+                    'tenant': {
+                        'type': 'keyword'
+                    },
+                    'file_name': {
+                        'type': 'text',
+                        # Exact file name, the documents of one file are replaced or deleted with it
+                        'fields': {
+                            'keyword': {
+                                'type': 'keyword'
+                            }
+                        }
+                    },
+                    'page': {
+                        'type': 'text'
+                    },
+                    'passage': {
+                        'type': 'text'
+                    },
+                    # Upload that last wrote or kept the document, the documents of older uploads are stale
+                    'version': {
+                        'type': 'keyword'
+                    }
+                }
+            }
+        }
 
-            print(response.text)
+        response = get_session().put(url, auth=HTTPBasicAuth(es_username, es_password), json=mapping)
+
+        # Another tenant's first upload may have created it in the meantime
+        if response.status_code == 400 and "resource_already_exists_exception" in response.text:
+            print('Shared index already exists')
+        else:
+            print(f'Shared index created: {response.text}')
     except Exception as e:
         stacktrace = traceback.format_exc()
         print("{}".format(stacktrace))
 
         raise e
 
+def update_file_name_mapping(url):
+    try:
+        # Indexes created before file_name.keyword existed: add it, and index the documents already stored into it
+        response = get_session().get(f'{url}/_mapping', auth=HTTPBasicAuth(es_username, es_password))
+        mappings = next(iter(response.json().values()))["mappings"]
+
+        # Indexes created before the upload version existed: documents without it are stale at the next upload
+        if "version" not in mappings.get("properties", {}):
+            response = get_session().put(f'{url}/_mapping', auth=HTTPBasicAuth(es_username, es_password),
+                                         json={"properties": {"version": {"type": "keyword"}}})
+            print(f'Version added to the index mapping: {response.text}')
+
+        if "keyword" in mappings.get("properties", {}).get("file_name", {}).get("fields", {}):
+            return
+
+        print('Adding file_name.keyword to the index mapping')
+        response = get_session().put(f'{url}/_mapping', auth=HTTPBasicAuth(es_username, es_password),
+                                     json={"properties": {"file_name": {"type": "text", "fields": {"keyword": {"type": "keyword"}}}}})
+        print(response.text)
+
+        response = get_session().post(f'{url}/_update_by_query', auth=HTTPBasicAuth(es_username, es_password),
+                                      params={"conflicts": "proceed", "refresh": "true"})
+        print(response.text)
+    except Exception as e:
+        stacktrace = traceback.format_exc()
+        print("{}".format(stacktrace))
+
+        raise e
+
+def get_document_id(chunk, tenant=None):
+    # The same passage of the same file and page always gets the same id, so unchanged passages are not written again
+    content = "\n".join([chunk["file_name"], str(chunk["page"]), chunk["passage"]])
+    document_id = hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+    return f"{tenant}-{document_id}" if tenant is not None else document_id
+
+def get_existing_ids(url, document_ids, tenant=None):
+    try:
+        existing_ids = set()
+        params = {"_source": "false"}
+
+        if tenant is not None:
+            params["routing"] = tenant
+
+        for i in range(0, len(document_ids), 1000):
+            response = get_session().post(f'{url}/_mget', auth=HTTPBasicAuth(es_username, es_password),
+                                          params=params, json={"ids": document_ids[i:i + 1000]})
+
+            if response.status_code == 404:
+                return existing_ids
+
+            existing_ids.update(doc["_id"] for doc in response.json()["docs"] if doc.get("found"))
+
+        return existing_ids
+    except Exception as e:
+        stacktrace = traceback.format_exc()
+        logger.error("{}".format(stacktrace))
+
+        raise e
+
+def delete_file_documents(url, file_name, version=None, tenant=None):
+    try:
+        # The documents of the file, except those written or kept by the upload version
+        query = {
+            "bool": {
+                "filter": [{"term": {"file_name.keyword": file_name}}]
+            }
+        }
+        params = {"refresh": "true", "conflicts": "proceed"}
+
+        if tenant is not None:
+            query["bool"]["filter"].append({"term": {"tenant": tenant}})
+            params["routing"] = tenant
+
+        if version is not None:
+            query["bool"]["must_not"] = [{"term": {"version": version}}]
+
+            # The query only sees searchable documents, the kept ones must be found with their new version
+            get_session().post(f'{url}/_refresh', auth=HTTPBasicAuth(es_username, es_password))
+
+        response = get_session().post(f'{url}/_delete_by_query', auth=HTTPBasicAuth(es_username, es_password),
+                                      params=params, json={"query": query})
+
+        if response.status_code == 404:
+            logger.info(f'No index to delete {file_name} from')
+            return 0
+
+        deleted = response.json().get("deleted", 0)
+        logger.info(f'Deleted {deleted} documents of {file_name}')
+
+        return deleted
+    except Exception as e:
+        stacktrace = traceback.format_exc()
+        logger.error("{}".format(stacktrace))
+
+        raise e
+
+def get_new_chunks(url, chunks, writer, stats, tenant=None, load=None):
+    # Chunks are checked against the index by windows of 500, so that the new ones stream into the indexing pipeline.
+    # Only the window is held, whatever the size of the file
+    window = {}
+
+    for chunk in chunks:
+        # Identical passages of one page in a window collapse into one document, later ones are written again
+        window[get_document_id(chunk, tenant)] = chunk
+
+        if len(window) == 500:
+            yield from filter_new_chunks(url, window, writer, stats, tenant, load)
+            window = {}
+
+    if window:
+        yield from filter_new_chunks(url, window, writer, stats, tenant, load)
+
+def filter_new_chunks(url, window, writer, stats, tenant=None, load=None):
+    existing_ids = get_existing_ids(url, list(window), tenant)
+    stats["passages"] += len(window)
+    stats["unchanged"] += len(existing_ids)
+
+    # Passages already indexed are kept: only their version is rewritten, they are not embedded again
+    for document_id in existing_ids:
+        writer.update(document_id, {"version": writer.version})
+
+    for document_id, chunk in window.items():
+        if document_id not in existing_ids:
+            stats["indexed"] += 1
+
+            if load is not None:
+                load.add()
+
+            yield chunk
+
+def update_file_documents(url, file_name, chunks, tenant=None):
+    try:
+        start = time.perf_counter()
+
+        # Every document written or kept by this upload carries its version, the others are deleted at the end
+        version = uuid.uuid4().hex
+        writer = BulkWriter(url, tenant, version)
+        stats = {"passages": 0, "unchanged": 0, "indexed": 0}
+        load = BulkLoad(url, tenant)
+
+        try:
+            index_documents(url, get_new_chunks(url, chunks, writer, stats, tenant, load), tenant, version)
+            kept = writer.close()
+        finally:
+            # Also after a failed load, an index left without refresh would hide every later write
+            load.restore()
+
+        # A kept passage whose version was not rewritten would be deleted with the stale ones
+        if kept["failed"] > 0:
+            raise Exception(f'{kept["failed"]} of {stats["unchanged"]} unchanged documents could not be kept')
+
+        # Passages of the previous version that are gone, removed once the new ones are searchable
+        deleted = delete_file_documents(url, file_name, version, tenant)
+        load.optimize()
+
+        logger.info(json.dumps({
+            "file_name": file_name,
+            "passages": stats["passages"],
+            "unchanged": stats["unchanged"],
+            "indexed": stats["indexed"],
+            "deleted": deleted,
+            "seconds": round(time.perf_counter() - start, 3)
+        }))
+
+        return stats["indexed"] > 0 or deleted > 0
+    except Exception as e:
+        stacktrace = traceback.format_exc()
+        logger.error("{}".format(stacktrace))
+
+        raise e
+
+def get_index_url(object_key):
+    # Returns the index of the object and, for a shared index, its tenant
+    if tenancy == "shared":
+        tenant = object_key.split("/")[3] if len(object_key.split("/")) == 5 else default_tenant
+
+        return es_url + "/" + es_index_name, tenant
+    elif len(object_key.split("/")) == 5:
+        index_name = object_key.split("/")[3]
+
+        return es_url + "/" + es_index_name + "-" + index_name, None
+    else:
+        return es_url + "/" + es_index_name, None
+
+def read_file(file_path):
+    with open(file_path, 'r') as file:
+        for piece in iter(lambda: file.read(1024 * 1024), ""):
+            yield piece
+
 def doc_iterator(dir_path: str):
     for root, _, filenames in os.walk(dir_path):
         for filename in filenames:
             file_path = os.path.join(root, filename)
             page = filename.split(".")[0].split("_")[-1]
             if os.path.isfile(file_path):
-                with open(file_path, 'r') as file:
-                    file_contents = file.read()
-                    yield filename, page, file_contents
+                yield filename, page, read_file(file_path)
+
+def get_windows(pieces, window_chars):
+    # Pieces of text in, windows of about window_chars out, cut at the last paragraph break, line break or space
+    buffer = ""
+
+    for piece in pieces:
+        buffer += piece
+
+        while len(buffer) >= window_chars:
+            end = buffer.rfind("\n\n", 0, window_chars)
+
+            if end <= 0:
+                end = buffer.rfind("\n", 0, window_chars)
+            if end <= 0:
+                end = buffer.rfind(" ", 0, window_chars)
+            if end <= 0:
+                end = window_chars
+
+            yield buffer[:end]
+            buffer = buffer[end:]
+
+    if buffer:
+        yield buffer
+
+def get_encoding():
+    global encoding
+
+    # tiktoken loads the cl100k_base ranks on first use, only the chunking path needs them
+    if encoding is None:
+        import tiktoken
+
+        encoding = tiktoken.get_encoding("cl100k_base")
+
+    return encoding
+
+def replace_line_break(match):
+    if match.group(1) is not None:
+        return match.group(1) + match.group(2)
+    elif match.group(3) is not None:
+        return "\n"
+    else:
+        return " "
+
+def normalize_text(text):
+    return normalize_pattern.sub(replace_line_break, text)
+
+def split_text(text):
+    # The text is encoded once, chunks are cut on the character offsets of its tokens
+    tokenizer = get_encoding()
+    tokens = tokenizer.encode_ordinary(text)
+
+    if not tokens:
+        return
+
+    text, offsets = tokenizer.decode_with_offsets(tokens)
+    offsets.append(len(text))
+    n_tokens = len(tokens)
+    start = 0
+    covered = 0
+
+    while start < n_tokens:
+        end = min(start + CHUNK_SIZE, n_tokens)
+
+        if end < n_tokens:
+            lower = offsets[start + CHUNK_SIZE // 2]
+
+            for separator in CHUNK_SEPARATORS:
+                position = text.rfind(separator, lower, offsets[end])
+
+                if position != -1:
+                    end = bisect.bisect_left(offsets, position + len(separator), start + 1, end)
+                    break
+
+        # Only a text that fits in one short chunk is dropped, a short tail is kept with its overlap
+        if covered or end - start >= CHUNK_SIZE_MIN:
+            passage = text[offsets[start]:offsets[end]].strip()
+
+            if passage:
+                yield passage
+
+        if end >= n_tokens:
+            break
+
+        # The next chunk repeats up to CHUNK_OVERLAP tokens, from the first word start when there is one
+        covered = end
+        overlap = max(end - CHUNK_OVERLAP, start + 1)
+        start = next((i for i in range(overlap, end) if text[offsets[i]].isspace()), overlap)
 
 def extract_blocks(job_id, job_status, file_path):
     if job_status == "SUCCEEDED":
+        from textractcaller.t_call import get_full_json, Textract_API
+
         blocks = get_full_json(
             job_id,
             textract_api=Textract_API.ANALYZE,
-            boto3_textract_client=textract_client
+            boto3_textract_client=get_client("textract")
         )
 
         write_blocks(blocks, file_path)
@@ -106,77 +535,736 @@ def extract_blocks(job_id, job_status, file_path):
 def get_chunks(file_name, object_key, file_path):
     try:
         print("Get file chunks")
-        chunks = []
+        from tqdm import tqdm
+
         total_passages = 0
 
-        for doc_name, page, doc in tqdm(doc_iterator(file_path)):
+        # Chunks are yielded page by page as the pages are read, the document is never held in memory
+        for doc_name, page, pieces in tqdm(doc_iterator(file_path)):
             n_passages = 0
 
-            doc = re.sub(r"(\w)-\n(\w)", r"\1\2", doc)
-            doc = re.sub(r"(?<!\n)\n(?!\n)", " ", doc)
-            doc = re.sub(r"\n{2,}", "\n", doc)
-
-            text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=CHUNK_SIZE,
-                separators=["\n\n", "\n", ".", "!", "?", ",", " ", ""],
-                chunk_overlap=200,
-            )
-
-            tmp_chunks = text_splitter.split_text(doc)
-
-            for i, chunk in enumerate(tmp_chunks):
-                chunks.append({
-                    "file_name": file_name,
-                    "page": page,
-                    "passage": chunk
-                })
-                n_passages += 1
-                total_passages += 1
+            for doc in get_windows(pieces, text_window_chars):
+                for chunk in split_text(normalize_text(doc)):
+                    yield {
+                        "file_name": file_name,
+                        "page": page,
+                        "passage": chunk
+                    }
+                    n_passages += 1
+                    total_passages += 1
 
             logger.info(f'Document segmented into {n_passages} passages')
 
         logger.info(f'Total passages to index: {total_passages}')
-
-        return chunks
     except Exception as e:
         stacktrace = traceback.format_exc()
         logger.error("{}".format(stacktrace))
 
         raise e
 
-def index_documents(url, chunks):
+def get_batches(chunks, batch_size, max_chars):
+    batch = []
+    batch_chars = 0
+
+    for chunk in chunks:
+        if batch and (len(batch) >= batch_size or batch_chars + len(chunk["passage"]) > max_chars):
+            yield batch
+
+            batch = []
+            batch_chars = 0
+
+        batch.append(chunk)
+        batch_chars += len(chunk["passage"])
+
+    if batch:
+        yield batch
+
+def embed_passages(passages, stats):
     try:
-        logger.info("Indexing documents")
+        payload = {'text_inputs': passages}
+        payload = json.dumps(payload).encode('utf-8')
 
-        i = 1
-        for chunk in chunks:
-            payload = {'text_inputs': [chunk["passage"]]}
-            payload = json.dumps(payload).encode('utf-8')
+        start = time.perf_counter()
+        response = get_client('sagemaker-runtime').invoke_endpoint(EndpointName=sagemaker_endpoint,
+                                                                   ContentType='application/json',
+                                                                   Body=payload)
 
-            response = sagemaker_runtime_client.invoke_endpoint(EndpointName=sagemaker_endpoint,
-                                                         ContentType='application/json',
-                                                         Body=payload)
+        model_predictions = json.loads(response['Body'].read())
+        latency = time.perf_counter() - start
 
-            model_predictions = json.loads(response['Body'].read())
-            embedding = model_predictions['embedding'][0]
+        stats["batches"] += 1
+        stats["passages"] += len(passages)
+        stats["seconds"] += latency
 
-            document = {
-                'embedding': embedding,
-                'file_name': chunk["file_name"],
-                'page': chunk["page"],
-                "passage": chunk["passage"]
-            }
+        logger.info(json.dumps({
+            "embedding_batch": stats["batches"],
+            "passages": len(passages),
+            "chars": sum(len(passage) for passage in passages),
+            "latency_ms": round(latency * 1000, 2),
+            "passages_per_s": round(len(passages) / latency, 2) if latency > 0 else None
+        }))
+
+        return model_predictions['embedding']
+    except ClientError as e:
+        # Payload over the endpoint limit or a model out of memory on the batch: retry both halves
+        if len(passages) > 1 and e.response["Error"]["Code"] in ["ValidationError", "ValidationException", "ModelError"]:
+            logger.info(f'Embedding batch of {len(passages)} passages rejected, splitting it: {e}')
+            stats["splits"] += 1
+            middle = len(passages) // 2
+
+            return embed_passages(passages[:middle], stats) + embed_passages(passages[middle:], stats)
+
+        raise e
+
+class BulkWriter:
+    # Buffers documents into NDJSON _bulk requests, only the items that failed with a retryable status are sent again
+    retryable_statuses = [429, 502, 503, 504]
+
+    def __init__(self, url, tenant=None, version=None):
+        self.url = url
+        self.tenant = tenant
+        self.version = version
+        self.max_docs = bulk_max_docs
+        self.max_bytes = bulk_max_bytes
+        self.max_retries = bulk_max_retries
+        self.backoff = bulk_retry_backoff
+        self.items = []
+        self.size = 0
+        self.stats = {"indexed": 0, "failed": 0, "retried": 0, "requests": 0, "seconds": 0.0}
+
+    def add(self, document_id, document):
+        if self.version is not None:
+            document["version"] = self.version
+
+        self.append("index", document_id, document)
+
+    def update(self, document_id, fields):
+        # Partial update of a stored document, its embedding is not sent again
+        self.append("update", document_id, {"doc": fields})
+
+    def append(self, operation, document_id, source):
+        action = {operation: {"_id": document_id}}
+
+        if self.tenant is not None:
+            action[operation]["routing"] = self.tenant
 
-            response = requests.post(f'{url}/_doc/{i}', auth=HTTPBasicAuth(es_username, es_password), json=document)
-            i += 1
+        item = (json.dumps(action) + "\n" + json.dumps(source) + "\n").encode("utf-8")
 
-            logger.info(response.text)
+        if self.items and (len(self.items) >= self.max_docs or self.size + len(item) > self.max_bytes):
+            self.flush()
 
-            if response.status_code not in [200, 201]:
-                logger.info(response.status_code)
-                logger.info(response.text)
+        self.items.append(item)
+        self.size += len(item)
+
+    def flush(self):
+        items = self.items
+        self.items = []
+        self.size = 0
+        attempt = 0
+
+        while items:
+            failed = self.send(items)
+
+            if not failed:
+                return
+
+            retryable = [item for item, status, error in failed if status in self.retryable_statuses]
+            rejected = [(status, error) for item, status, error in failed if status not in self.retryable_statuses]
+
+            if attempt >= self.max_retries:
+                rejected = [(status, error) for item, status, error in failed]
+                retryable = []
+
+            if rejected:
+                self.stats["failed"] += len(rejected)
+                self.log_errors(rejected, attempt)
+
+            if not retryable:
+                return
+
+            attempt += 1
+            self.stats["retried"] += len(retryable)
+            logger.info(f"Retrying {len(retryable)} documents, attempt {attempt}")
+            time.sleep(self.backoff * 2 ** (attempt - 1))
+
+            items = retryable
+
+    def log_errors(self, rejected, attempt):
+        # One line per status and error type, a rejected batch would otherwise log every document
+        errors = {}
+
+        for status, error in rejected:
+            error_type = error.get("type") if isinstance(error, dict) else error
+            key = (status, error_type)
+            errors[key] = errors.get(key, 0) + 1
+
+        for (status, error_type), count in errors.items():
+            logger.error(f"{count} documents not indexed after {attempt} retries, status {status}: {error_type}")
+
+    def send(self, items):
+        start = time.perf_counter()
+
+        try:
+            response = get_session().post(f'{self.url}/_bulk', auth=HTTPBasicAuth(es_username, es_password),
+                                          data=b"".join(items), headers={"Content-Type": "application/x-ndjson"})
+        except requests.exceptions.ConnectionError as e:
+            # The whole request is retried like a throttled one
+            return [(item, 503, str(e)) for item in items]
+        finally:
+            self.stats["requests"] += 1
+            self.stats["seconds"] += time.perf_counter() - start
+
+        if response.status_code != 200:
+            return [(item, response.status_code, response.text[:500]) for item in items]
+
+        result = response.json()
+        failed = []
+
+        for item, response_item in zip(items, result["items"]):
+            status = next(iter(response_item.values()))
+
+            if status.get("status", 500) >= 300:
+                failed.append((item, status.get("status", 500), status.get("error")))
+            else:
+                self.stats["indexed"] += 1
+
+        return failed
+
+    def close(self):
+        if self.items:
+            self.flush()
+
+        return self.stats
+
+class BulkLoad:
+    # Refresh and replicas are turned off while a large file is written, then restored, force-merged and warmed up.
+    # The settings to restore are kept in the index mapping _meta, so that concurrent loads of the index restore them
+    # once and a load that timed out leaves them to the next one
+    def __init__(self, url, tenant=None):
+        self.url = url
+        # The shared index serves every tenant, its settings are left as they are
+        self.enabled = bulk_load and tenant is None
+        self.min_documents = bulk_load_min_documents
+        self.max_segments = bulk_load_max_segments
+        self.timeout = bulk_load_timeout
+        self.documents = 0
+        self.started = False
+        # Settings to restore, None while this load does not own the bulk-load state of the index
+        self.saved = None
+        self.stats = {"restore_seconds": 0.0, "force_merge_seconds": 0.0, "warmup_seconds": 0.0}
+
+    def add(self):
+        # Called for every new passage, the mode only pays off once the file brings enough of them
+        self.documents += 1
+
+        if self.enabled and not self.started and self.documents >= self.min_documents:
+            self.start()
+
+    def get_meta(self):
+        response = get_session().get(f'{self.url}/_mapping', auth=HTTPBasicAuth(es_username, es_password))
+
+        return next(iter(response.json().values()))["mappings"].get("_meta", {})
+
+    def start(self):
+        self.started = True
+
+        response = get_session().get(f'{self.url}/_settings', auth=HTTPBasicAuth(es_username, es_password))
+        settings = next(iter(response.json().values()))["settings"]["index"]
+        meta = self.get_meta()
+        load = meta.get("bulk_load")
+
+        if load is not None and time.time() - load["started_at"] < self.timeout:
+            logger.info("Bulk load already in progress, its settings are restored by the load that started it")
+
+            return
+
+        if load is not None:
+            saved = {"refresh_interval": load["refresh_interval"], "number_of_replicas": load["number_of_replicas"]}
+        else:
+            # A missing refresh_interval is the default one, null restores it
+            saved = {"refresh_interval": settings.get("refresh_interval"), "number_of_replicas": settings["number_of_replicas"]}
+
+        response = get_session().put(f'{self.url}/_mapping', auth=HTTPBasicAuth(es_username, es_password),
+                                     json={"_meta": {**meta, "bulk_load": {"started_at": time.time(), **saved}}})
+
+        if response.status_code != 200:
+            raise Exception(f'Bulk load could not be recorded: {response.text}')
+
+        self.saved = saved
+
+        response = get_session().put(f'{self.url}/_settings', auth=HTTPBasicAuth(es_username, es_password),
+                                     json={"index": {"refresh_interval": "-1", "number_of_replicas": 0}})
+        logger.info(f'Bulk load started after {self.documents} new passages: {response.text}')
+
+    def restore(self):
+        if self.saved is None:
+            return
+
+        start = time.perf_counter()
+        response = get_session().put(f'{self.url}/_settings', auth=HTTPBasicAuth(es_username, es_password),
+                                     json={"index": self.saved})
+
+        if response.status_code != 200:
+            raise Exception(f'Index settings {self.saved} could not be restored: {response.text}')
+
+        response = get_session().put(f'{self.url}/_mapping', auth=HTTPBasicAuth(es_username, es_password),
+                                     json={"_meta": {**self.get_meta(), "bulk_load": None}})
+        self.stats["restore_seconds"] = time.perf_counter() - start
+
+        logger.info(f'Index settings restored: {self.saved}')
+
+    def optimize(self):
+        # After a successful load: fewer segments, and graphs loaded before the first query instead of by it
+        if self.saved is None:
+            return
+
+        get_session().post(f'{self.url}/_refresh', auth=HTTPBasicAuth(es_username, es_password))
+
+        if self.max_segments > 0:
+            start = time.perf_counter()
+            response = get_session().post(f'{self.url}/_forcemerge', auth=HTTPBasicAuth(es_username, es_password),
+                                          params={"max_num_segments": self.max_segments})
+            self.stats["force_merge_seconds"] = time.perf_counter() - start
+
+            logger.info(f'Index force-merged: {response.text}')
+
+        start = time.perf_counter()
+        es_base_url, index_name = self.url.rsplit("/", 1)
+        response = get_session().get(f'{es_base_url}/_plugins/_knn/warmup/{index_name}',
+                                     auth=HTTPBasicAuth(es_username, es_password))
+        self.stats["warmup_seconds"] = time.perf_counter() - start
+
+        logger.info(f'k-NN graphs warmed up: {response.text}')
+        logger.info(json.dumps({
+            "bulk_load": index_name,
+            "documents": self.documents,
+            **{key: round(value, 3) for key, value in self.stats.items()}
+        }))
+
+def get_passage_hash(passage):
+    return hashlib.sha256(passage.encode("utf-8")).hexdigest()
+
+def pack_embedding(embedding):
+    # float32 bytes, a quarter of the JSON size and what the k-NN index keeps anyway
+    return array.array("f", embedding).tobytes()
+
+def unpack_embedding(data):
+    embedding = array.array("f")
+    embedding.frombytes(data)
+
+    return embedding.tolist()
+
+class EmbeddingStore:
+    # Embeddings by passage hash, for one endpoint and model version
+    def __init__(self, endpoint_name, model_version):
+        self.endpoint_name = endpoint_name
+        self.model_version = model_version
+
+    def get_many(self, passage_hashes):
+        raise NotImplementedError
+
+    def put_many(self, embeddings):
+        raise NotImplementedError
+
+class NoEmbeddingStore(EmbeddingStore):
+    def get_many(self, passage_hashes):
+        return {}
+
+    def put_many(self, embeddings):
+        pass
+
+class SQLiteEmbeddingStore(EmbeddingStore):
+    # Local file, kept by the warm containers of the Lambda or on a mounted volume
+    def __init__(self, endpoint_name, model_version, path, max_entries):
+        super().__init__(endpoint_name, model_version)
+
+        import sqlite3
+
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (endpoint TEXT, version TEXT, hash TEXT, embedding BLOB, "
+            "created_at REAL, PRIMARY KEY (endpoint, version, hash))"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_created_at ON embeddings (created_at)")
+        self.connection.commit()
+
+    def get_many(self, passage_hashes):
+        embeddings = {}
+
+        with self.lock:
+            for i in range(0, len(passage_hashes), 500):
+                hashes = passage_hashes[i:i + 500]
+                rows = self.connection.execute(
+                    "SELECT hash, embedding FROM embeddings WHERE endpoint = ? AND version = ? AND hash IN ({})".format(
+                        ", ".join("?" * len(hashes))),
+                    (self.endpoint_name, self.model_version, *hashes)
+                ).fetchall()
+
+                embeddings.update((passage_hash, unpack_embedding(data)) for passage_hash, data in rows)
+
+        return embeddings
+
+    def put_many(self, embeddings):
+        now = time.time()
+
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (endpoint, version, hash, embedding, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(self.endpoint_name, self.model_version, passage_hash, pack_embedding(embedding), now)
+                 for passage_hash, embedding in embeddings.items()]
+            )
+            # The oldest entries go first, a 4096-dim embedding takes 16 KB of the Lambda /tmp
+            self.connection.execute(
+                "DELETE FROM embeddings WHERE rowid IN (SELECT rowid FROM embeddings ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self.connection.commit()
+
+class S3EmbeddingStore(EmbeddingStore):
+    # One object per passage, shared by every container and every index
+    def __init__(self, endpoint_name, model_version, bucket, prefix):
+        super().__init__(endpoint_name, model_version)
+
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def get_key(self, passage_hash):
+        return f"{self.prefix}/{self.endpoint_name}/{self.model_version}/{passage_hash}"
+
+    def get(self, passage_hash):
+        try:
+            response = get_client('s3').get_object(Bucket=self.bucket, Key=self.get_key(passage_hash))
+
+            return unpack_embedding(response["Body"].read())
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ["NoSuchKey", "404"]:
+                return None
+
+            raise e
+
+    def put(self, passage_hash, embedding):
+        get_client('s3').put_object(Bucket=self.bucket, Key=self.get_key(passage_hash), Body=pack_embedding(embedding))
+
+    def get_many(self, passage_hashes):
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            embeddings = executor.map(self.get, passage_hashes)
+
+            return {passage_hash: embedding for passage_hash, embedding in zip(passage_hashes, embeddings)
+                    if embedding is not None}
+
+    def put_many(self, embeddings):
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            list(executor.map(self.put, embeddings.keys(), embeddings.values()))
+
+def get_embedding_store():
+    global embedding_store
+
+    if embedding_store is None:
+        if embedding_cache_type == "sqlite":
+            embedding_store = SQLiteEmbeddingStore(sagemaker_endpoint, embedding_model_version, embedding_cache_path,
+                                                   embedding_cache_max_entries)
+        elif embedding_cache_type == "s3":
+            embedding_store = S3EmbeddingStore(sagemaker_endpoint, embedding_model_version, embedding_cache_bucket,
+                                               embedding_cache_prefix)
+        else:
+            embedding_store = NoEmbeddingStore(sagemaker_endpoint, embedding_model_version)
+
+    return embedding_store
+
+class IndexingPipeline:
+    # Producer -> embedding workers -> bulk consumer over bounded queues: a full queue blocks the stage feeding it,
+    # so at most queue_size batches are held between two stages whatever the size of the file
+    def __init__(self, url, tenant=None, version=None):
+        self.url = url
+        self.tenant = tenant
+        self.version = version
+        self.concurrency = embedding_concurrency
+        self.embedding_queue = queue.Queue(maxsize=pipeline_queue_size)
+        self.index_queue = queue.Queue(maxsize=pipeline_queue_size)
+        self.stop = threading.Event()
+        self.errors = []
+        self.lock = threading.Lock()
+        self.stats = {
+            "produce": {"items": 0, "batches": 0, "blocked_seconds": 0.0, "seconds": 0.0},
+            "embed": {"items": 0, "batches": 0, "splits": 0, "busy_seconds": 0.0, "blocked_seconds": 0.0, "seconds": 0.0},
+            "index": {"items": 0, "idle_seconds": 0.0, "seconds": 0.0},
+            "cache": {"hits": 0, "misses": 0, "lookup_seconds": 0.0, "store_seconds": 0.0}
+        }
+
+    def fail(self, e):
+        # The first error is raised by run once every thread stopped, the other stages stop at their next queue operation
+        with self.lock:
+            self.errors.append(e)
+
+        self.stop.set()
+
+    def put(self, items_queue, item, stage):
+        # Waits while the next stage is behind, gives up when another stage failed
+        start = time.perf_counter()
+
+        while not self.stop.is_set():
+            try:
+                items_queue.put(item, timeout=0.1)
                 break
+            except queue.Full:
+                continue
+
+        with self.lock:
+            self.stats[stage]["blocked_seconds"] += time.perf_counter() - start
+
+        return not self.stop.is_set()
+
+    def get(self, items_queue):
+        while not self.stop.is_set():
+            try:
+                return items_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+        return None
+
+    def lookup(self, chunks):
+        # Cached passages go straight to the bulk writer, only the others are batched for the endpoint
+        group = []
+
+        for chunk in chunks:
+            group.append(chunk)
+
+            if len(group) == 128:
+                yield from self.lookup_group(group)
+                group = []
+
+        if group:
+            yield from self.lookup_group(group)
+
+    def lookup_group(self, group):
+        self.stats["produce"]["items"] += len(group)
+        passage_hashes = [get_passage_hash(chunk["passage"]) for chunk in group]
+        start = time.perf_counter()
+
+        try:
+            cached = get_embedding_store().get_many(list(set(passage_hashes)))
+        except Exception as e:
+            # A cache failure costs endpoint calls, not the ingestion
+            logger.warning(f'Embedding cache lookup failed: {e}')
+            cached = {}
+
+        self.stats["cache"]["lookup_seconds"] += time.perf_counter() - start
+
+        hits = [(chunk, cached[passage_hash]) for chunk, passage_hash in zip(group, passage_hashes) if passage_hash in cached]
+        self.stats["cache"]["hits"] += len(hits)
+        self.stats["cache"]["misses"] += len(group) - len(hits)
+
+        # Queued like the embedded batches, a queue slot holds at most one batch of embeddings
+        for i in range(0, len(hits), embedding_batch_size):
+            batch = hits[i:i + embedding_batch_size]
 
+            if not self.put(self.index_queue, ([chunk for chunk, _ in batch], [embedding for _, embedding in batch]), "produce"):
+                return
+
+        for chunk, passage_hash in zip(group, passage_hashes):
+            if passage_hash not in cached:
+                yield chunk
+
+    def produce(self, chunks):
+        start = time.perf_counter()
+
+        try:
+            for batch in get_batches(self.lookup(chunks), embedding_batch_size, embedding_batch_max_chars):
+                if not self.put(self.embedding_queue, batch, "produce"):
+                    return
+
+                self.stats["produce"]["batches"] += 1
+        except Exception as e:
+            self.fail(e)
+        finally:
+            # One end marker per worker
+            for _ in range(self.concurrency):
+                self.put(self.embedding_queue, None, "produce")
+
+            self.stats["produce"]["seconds"] = time.perf_counter() - start
+
+    def embed(self):
+        stats = {"batches": 0, "passages": 0, "splits": 0, "seconds": 0.0}
+
+        try:
+            while True:
+                item = self.get(self.embedding_queue)
+
+                if item is None:
+                    break
+
+                embeddings = embed_passages([chunk["passage"] for chunk in item], stats)
+                self.store(item, embeddings)
+
+                if not self.put(self.index_queue, (item, embeddings), "embed"):
+                    break
+        except Exception as e:
+            self.fail(e)
+        finally:
+            with self.lock:
+                self.stats["embed"]["items"] += stats["passages"]
+                self.stats["embed"]["batches"] += stats["batches"]
+                self.stats["embed"]["splits"] += stats["splits"]
+                self.stats["embed"]["busy_seconds"] += stats["seconds"]
+
+            self.put(self.index_queue, None, "embed")
+
+    def store(self, batch, embeddings):
+        start = time.perf_counter()
+
+        try:
+            get_embedding_store().put_many({
+                get_passage_hash(chunk["passage"]): embedding for chunk, embedding in zip(batch, embeddings)
+            })
+        except Exception as e:
+            logger.warning(f'Embedding cache update failed: {e}')
+
+        with self.lock:
+            self.stats["cache"]["store_seconds"] += time.perf_counter() - start
+
+    def index(self, writer):
+        start = time.perf_counter()
+        running = self.concurrency
+
+        while running > 0:
+            wait_start = time.perf_counter()
+            item = self.get(self.index_queue)
+            self.stats["index"]["idle_seconds"] += time.perf_counter() - wait_start
+
+            if self.stop.is_set():
+                return
+            if item is None:
+                running -= 1
+                continue
+
+            batch, embeddings = item
+
+            for chunk, embedding in zip(batch, embeddings):
+                document = {
+                    'embedding': embedding,
+                    'file_name': chunk["file_name"],
+                    'page': chunk["page"],
+                    "passage": chunk["passage"]
+                }
+
+                if self.tenant is not None:
+                    document["tenant"] = self.tenant
+
+                writer.add(get_document_id(chunk, self.tenant), document)
+                self.stats["index"]["items"] += 1
+
+        writer.close()
+        self.stats["index"]["seconds"] = time.perf_counter() - start
+
+    def run(self, chunks):
+        global embedding_seconds_per_passage
+
+        writer = BulkWriter(self.url, self.tenant, self.version)
+        # Created once here, boto3 clients are thread safe but their creation is not
+        get_client('sagemaker-runtime')
+        get_embedding_store()
+
+        start = time.perf_counter()
+        producer = threading.Thread(target=self.produce, args=(chunks,), daemon=True)
+        workers = [threading.Thread(target=self.embed, daemon=True) for _ in range(self.concurrency)]
+
+        producer.start()
+        for worker in workers:
+            worker.start()
+
+        try:
+            self.index(writer)
+        except Exception as e:
+            self.fail(e)
+
+        producer.join()
+        for worker in workers:
+            worker.join()
+
+        self.stats["embed"]["seconds"] = time.perf_counter() - start
+
+        if self.stats["embed"]["items"] > 0:
+            embedding_seconds_per_passage = self.stats["embed"]["busy_seconds"] / self.stats["embed"]["items"]
+
+        self.log_stats(writer.stats, time.perf_counter() - start)
+
+        if self.errors:
+            raise self.errors[0]
+
+        return writer.stats
+
+    def log_stats(self, bulk_stats, elapsed):
+        def get_rate(items, seconds):
+            return round(items / seconds, 2) if seconds > 0 else None
+
+        logger.info(json.dumps({
+            "embedding_concurrency": self.concurrency,
+            "queue_size": pipeline_queue_size,
+            "produced_chunks": self.stats["produce"]["items"],
+            "produce_chunks_per_s": get_rate(self.stats["produce"]["items"], self.stats["produce"]["seconds"]),
+            "produce_blocked_seconds": round(self.stats["produce"]["blocked_seconds"], 3),
+            "embedding_batches": self.stats["embed"]["batches"],
+            "embedding_splits": self.stats["embed"]["splits"],
+            "passages": self.stats["embed"]["items"],
+            "embedding_seconds": round(self.stats["embed"]["busy_seconds"], 3),
+            "embedding_passages_per_s": get_rate(self.stats["embed"]["items"], self.stats["embed"]["seconds"]),
+            "embedding_blocked_seconds": round(self.stats["embed"]["blocked_seconds"], 3),
+            "cache_type": embedding_cache_type,
+            "cache_hits": self.stats["cache"]["hits"],
+            "cache_misses": self.stats["cache"]["misses"],
+            "cache_hit_ratio": get_rate(self.stats["cache"]["hits"], self.stats["produce"]["items"]),
+            "cache_lookup_seconds": round(self.stats["cache"]["lookup_seconds"], 3),
+            "cache_store_seconds": round(self.stats["cache"]["store_seconds"], 3),
+            "endpoint_seconds_saved": round(self.stats["cache"]["hits"] * embedding_seconds_per_passage, 3)
+            if embedding_seconds_per_passage is not None else None,
+            "bulk_requests": bulk_stats["requests"],
+            "bulk_seconds": round(bulk_stats["seconds"], 3),
+            "index_docs_per_s": get_rate(self.stats["index"]["items"], self.stats["index"]["seconds"]),
+            "index_idle_seconds": round(self.stats["index"]["idle_seconds"], 3),
+            "indexed": bulk_stats["indexed"],
+            "failed": bulk_stats["failed"],
+            "retried": bulk_stats["retried"],
+            "total_seconds": round(elapsed, 3)
+        }))
+
+def index_documents(url, chunks, tenant=None, version=None):
+    try:
+        logger.info("Indexing documents")
+
+        bulk_stats = IndexingPipeline(url, tenant, version).run(chunks)
+
+        if bulk_stats["failed"] > 0:
+            raise Exception(f'{bulk_stats["failed"]} of {bulk_stats["failed"] + bulk_stats["indexed"]} documents could not be indexed')
+    except Exception as e:
+        stacktrace = traceback.format_exc()
+        logger.error("{}".format(stacktrace))
+
+        raise e
+
+def mark_index_updated(url, tenant=None):
+    try:
+        if tenant is not None:
+            # Shared index: a per-tenant generation document, so that other tenants keep their cached answers
+            response = get_session().put(f'{url}/_doc/_generation-{tenant}', auth=HTTPBasicAuth(es_username, es_password),
+                                    params={"routing": tenant, "refresh": "true"},
+                                    json={"tenant": tenant, "updated_at": time.time()})
+
+            logger.info(f'Tenant {tenant} marked as updated: {response.text}')
+
+            return
+
+        # Stamp the mapping _meta so that the backend drops the semantic answers cached for this index. _meta is
+        # replaced as a whole, its other keys such as a bulk load in progress are written back
+        response = get_session().get(f'{url}/_mapping', auth=HTTPBasicAuth(es_username, es_password))
+        meta = next(iter(response.json().values()))["mappings"].get("_meta", {})
+
+        response = get_session().put(f'{url}/_mapping', auth=HTTPBasicAuth(es_username, es_password),
+                                json={"_meta": {**meta, "updated_at": time.time()}})
+
+        logger.info(f'Index marked as updated: {response.text}')
     except Exception as e:
         stacktrace = traceback.format_exc()
         logger.error("{}".format(stacktrace))
@@ -185,6 +1273,8 @@ def index_documents(url, chunks):
 
 def write_blocks(textract_resp, file_path):
     try:
+        from trp import Document
+
         doc = Document(textract_resp)
 
         page_number = 1
@@ -229,7 +1319,25 @@ def lambda_handler(event, context):
         if status_code == 200:
             event_type = event["body"]["EventType"]
 
-            if event_type and event_type != "ObjectRemoved:Delete":
+            if event_type == "ObjectRemoved:Delete":
+                object_key = event["body"]["ObjectKey"]
+                file_name = object_key.split("/")[-1]
+                new_es_url, tenant = get_index_url(object_key)
+
+                logger.info("Deleted object {}".format(object_key))
+
+                if delete_file_documents(new_es_url, file_name, tenant=tenant) > 0:
+                    mark_index_updated(new_es_url, tenant)
+
+                results["BucketName"] = event["body"]["BucketName"]
+                results["EventType"] = event_type
+                results["ObjectKey"] = object_key
+
+                return {
+                    'statusCode': 200,
+                    'body': results
+                }
+            elif event_type:
                 if event["body"]["JobId"] is not None:
                     logger.info("Get textract outputs")
 
@@ -246,17 +1354,13 @@ def lambda_handler(event, context):
 
                     chunks = get_chunks(file_name, object_key, os.path.join(output_file_path, job_id))
 
-                    if len(object_key.split("/")) == 5:
-                        index_name = object_key.split("/")[3]
-                        new_es_url = es_url + "/" + es_index_name + "-" + index_name
-                    else:
-                        new_es_url = es_url + "/" + es_index_name
-
-                    delete_index(new_es_url)
+                    new_es_url, tenant = get_index_url(object_key)
 
-                    create_index(new_es_url)
+                    create_index(new_es_url, tenant)
 
-                    index_documents(new_es_url, chunks)
+                    # Only the passages that changed since the previous upload of the file are embedded
+                    if update_file_documents(new_es_url, file_name, chunks, tenant):
+                        mark_index_updated(new_es_url, tenant)
 
                     results["BucketName"] = bucket_name
                     results["EventType"] = event_type
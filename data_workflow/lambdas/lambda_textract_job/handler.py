@@ -97,6 +97,11 @@ def lambda_handler(event, context):
                 results["JobId"] = response["JobId"]
                 results["JobStatus"] = response_text["JobStatus"]
                 results["ObjectKey"] = object_key
+            else:
+                # No Textract job, the index Lambda drops the documents of the deleted file
+                results["BucketName"] = event["Records"][0]["s3"]["bucket"]["name"]
+                results["EventType"] = event_type
+                results["ObjectKey"] = unquote_plus(event["Records"][0]["s3"]["object"]["key"])
 
             return {
                 'statusCode': 200,
@@ -1,3 +1,4 @@
+import itertools
 from utils import service
 
 ## Page
@@ -18,15 +19,55 @@ class Page:
             run = st.form_submit_button("Run")
 
             if run and prompt:
-                with st.spinner("Loading..."):
-                    answer = service.get_answer(st, config, selected_type, selected_endpoint, prompt)
+                if config["backend"].get("stream", False):
+                    answer = self.stream_answer(st, config, message_container, selected_type, selected_endpoint, prompt)
+                else:
+                    with st.spinner("Loading..."):
+                        answer = service.get_answer(st, config, selected_type, selected_endpoint, prompt)
 
-                    st.session_state["chat_messages"].append({
-                        "user": prompt,
-                        "answer": answer
-                    })
+                st.session_state["chat_messages"].append({
+                    "user": prompt,
+                    "answer": answer
+                })
 
-                    st.session_state["history"].append((prompt, answer["answer"]))
+                st.session_state["history"].append((prompt, answer["answer"]))
+
+    ## stream_answer
+    #   Renders the token frames in a placeholder and returns the final answer with its sources.
+    #   The spinner stays until the first frame arrives, the retrieval and the prompt come before the first token.
+    def stream_answer(self, st, config, message_container, selected_type, selected_endpoint, prompt):
+        with message_container:
+            placeholder = st.empty()
+
+        text = ""
+        answer = None
+        frames = service.get_answer_stream(st, config, selected_type, selected_endpoint, prompt)
+
+        with st.spinner("Loading..."):
+            first_frame = next(frames, None)
+
+        for frame in itertools.chain([first_frame] if first_frame is not None else [], frames):
+            if frame["type"] == "token":
+                text += frame["text"]
+                self.print_stream(st, placeholder, prompt, text)
+            elif frame["type"] == "answer":
+                answer = {
+                    "answer": frame["answer"],
+                    "sources": frame["sources"]
+                }
+
+        placeholder.empty()
+
+        if answer is None:
+            answer = {
+                "answer": "Unfortunately, I can't help you with that.",
+                "sources": []
+            }
+
+        return answer
+
+    def print_stream(self, st, placeholder, prompt, text):
+        placeholder.markdown(text)
 
     def print_answer(self, st, config, chat_message):
         pass